@@ -4,31 +4,76 @@ This can also contain game logic. For more complex games it would be wise to
 move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
-import random
 import logging
+from datetime import date
 import endpoints
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
 
-from models import User, Game, Score
-from models import StringMessage, NewGameForm, GameForm, MakeMoveForm,\
+from models import Game, Score, Leaderboard, resolve_user_names
+from models import StringMessage, NewGameForm, NewGamesForm, GameForm,\
+    MakeMoveForm,\
+    MakeMovesForm, MoveResultForm, MovesResultForm,\
     ScoreForms, GameForms, UserForm, UserForms, MovesForm
-from utils import get_by_urlsafe
-from word import wordlist
+from utils import get_key_by_urlsafe, add_coalesced_task_async
+from repository import MAX_PAGE_SIZE
+from engine import GameEngine, NotFoundError, ConflictError,\
+    BadRequestError
+from ndb_repository import NdbRepository
+from instrumentation import instrumented
+from tasks import AVERAGE_ATTEMPTS_MESSAGE, AVERAGE_ATTEMPTS_TASK,\
+    AVERAGE_ATTEMPTS_DEBOUNCE
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
+NEW_GAMES_REQUEST = endpoints.ResourceContainer(NewGamesForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1),)
+GAME_STATE_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    if_version=messages.IntegerField(2))
+GET_GAMES_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_keys=messages.StringField(1, repeated=True))
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1),)
+HISTORY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    offset=messages.IntegerField(2),
+    limit=messages.IntegerField(3),
+    if_version=messages.IntegerField(4))
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
 SCORE_REQUEST = endpoints.ResourceContainer(
-   limit= messages.IntegerField(1))
-
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
-
+   limit= messages.IntegerField(1),
+   page_size=messages.IntegerField(2),
+   cursor=messages.StringField(3))
+SCORES_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1),
+    cursor=messages.StringField(2))
+LEADERBOARD_REQUEST = endpoints.ResourceContainer(
+    period=messages.StringField(1))
+RANKINGS_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1),
+    cursor=messages.StringField(2))
+
+# Most games new_games creates in one request
+MAX_NEW_GAMES = 100
+
+game_engine = GameEngine(NdbRepository())
+
+
+def call_engine(function, *args):
+    """Calls a method of the game engine, raising its errors as the
+    endpoints exceptions"""
+    try:
+        return function(*args)
+    except NotFoundError, e:
+        raise endpoints.NotFoundException(str(e))
+    except ConflictError, e:
+        raise endpoints.ConflictException(str(e))
+    except BadRequestError, e:
+        raise endpoints.BadRequestException(str(e))
 
 
 
@@ -42,267 +87,286 @@ class HangManApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
-            raise endpoints.ConflictException(
-                    'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
+        call_engine(game_engine.create_user, request.user_name,
+                    request.email)
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
-    def pickaWord(self):
-        """pick a word from the list for the game """
-        wordlistlen = len(wordlist)
-        targetnum=random.choice(range(0, wordlistlen))
-        a = wordlist[targetnum]
-        b = ""
-        for i in range(len(a)):
-          b = b + "*"
-        return [a,b]
-
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=GameForm,
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
     def new_game(self, request):
         """Creates new game"""
-        if 1 > request.attempts or request.attempts > 14:
-          raise endpoints.BadRequestException('Attempts should not be less than 1 or '
-            'greater than 14!')
-        user = User.query(User.name == request.user_name).get()
-        if not user:
-            raise endpoints.NotFoundException(
-                    'A User with that name does not exist!')
-        try:
-            target = self.pickaWord()
-            game = Game.new_game(user.key, request.attempts, target[0], target[1],
-              ['{} created a new game'.format(user.name),])
-        except:
-            print 'mark 1: something wrong with creating a new game'
-
         # Use a task queue to update the average attempts remaining.
         # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_attempts')
+        # so it is performed out of sequence, and coalesced so a burst of new
+        # games only triggers one recompute per debounce interval. The task
+        # is enqueued while the game is being written.
+        task = add_coalesced_task_async(AVERAGE_ATTEMPTS_TASK,
+                                        '/tasks/cache_average_attempts',
+                                        AVERAGE_ATTEMPTS_DEBOUNCE)
+        try:
+            game = call_engine(game_engine.new_games, request.user_name,
+                               request.attempts)[0]
+        finally:
+            task.get_result()
         return game.to_form('Good luck playing Hangman!')
 
     
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=NEW_GAMES_REQUEST,
+                      response_message=GameForms,
+                      path='games',
+                      name='new_games',
+                      http_method='POST')
+    @instrumented
+    def new_games(self, request):
+        """Creates count new games for one User. The User is looked up once
+        and the games are written with a single batch put"""
+        if 1 > request.count or request.count > MAX_NEW_GAMES:
+            raise endpoints.BadRequestException(
+                'Count should not be less than 1 or greater than {}!'.format(
+                    MAX_NEW_GAMES))
+        # One coalesced recompute covers the whole batch, see new_game
+        task = add_coalesced_task_async(AVERAGE_ATTEMPTS_TASK,
+                                        '/tasks/cache_average_attempts',
+                                        AVERAGE_ATTEMPTS_DEBOUNCE)
+        try:
+            games = call_engine(game_engine.new_games, request.user_name,
+                                request.attempts, request.count)
+        finally:
+            task.get_result()
+        return GameForms(games=[game.to_form('Good luck playing Hangman!')
+                                for game in games])
+
+    @endpoints.method(request_message=GET_GAMES_REQUEST,
+                      response_message=GameForms,
+                      path='games',
+                      name='get_games',
+                      http_method='GET')
+    @instrumented
+    def get_games(self, request):
+        """Return the current state of many games at once. Games that do not
+        exist are left out"""
+        if len(request.urlsafe_game_keys) > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                'No more than {} games can be fetched at once!'.format(
+                    MAX_PAGE_SIZE))
+        games = game_engine.get_games(request.urlsafe_game_keys)
+        user_names = resolve_user_names(games)
+        return GameForms(games=[
+            game.to_form('The game is over!' if game.game_over
+                         else 'Time to make a move!',
+                         user_names.get(game.user))
+            for game in games])
+
+    @endpoints.method(request_message=GAME_STATE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
-        """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            if game.game_over:
-              return game.to_form('The game is over!')
-            else:
-              return game.to_form('Time to make a move!')
+        """Return the current game state. If if_version is still the game's
+        version only a not modified form is returned, without reading the
+        game"""
+        if Game.is_unchanged(request.urlsafe_game_key, request.if_version):
+            return GameForm(urlsafe_key=request.urlsafe_game_key,
+                            version=request.if_version, not_modified=True,
+                            message='Not modified')
+        game = call_engine(game_engine.get_game, request.urlsafe_game_key)
+        game.remember_version()
+        if game.game_over:
+          return game.to_form('The game is over!')
         else:
-            raise endpoints.NotFoundException('Game not found!')
+          return game.to_form('Time to make a move!')
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=HISTORY_REQUEST,
                       response_message=MovesForm,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
     def get_game_history(self, request):
-        """Return the current game history."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-
-        if game:
-            form = MovesForm()
-            form.moves = game.moves
-            return form
-        else:
-            raise endpoints.NotFoundException('Game not found!')
+        """Return the current game history. If if_version is still the
+        game's version only a not modified form is returned, without reading
+        the game"""
+        if Game.is_unchanged(request.urlsafe_game_key, request.if_version):
+            return MovesForm(version=request.if_version, not_modified=True)
+        game = call_engine(game_engine.get_game, request.urlsafe_game_key)
+        game.remember_version()
+        form = MovesForm()
+        form.moves = game.render_moves(request.offset, request.limit)
+        form.version = game.version
+        return form
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='game/cancel/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='POST')
+    @instrumented
     def cancel_game(self, request):
         """cancel the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-          if not game.game_over:
-                game.key.delete()
-                return StringMessage(message='Game canceled!')
-          else:
-            raise endpoints.BadRequestException('Game already over!')
-        else:
-            raise endpoints.NotFoundException('Game not found!')
+        call_engine(game_engine.cancel_game, request.urlsafe_game_key)
+        return StringMessage(message='Game canceled!')
 
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=GameForms,
                       path='game/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
     def get_user_games(self, request):
         """Returns all of an individual User's games"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
-            raise endpoints.NotFoundException(
-                    'A User with that name does not exist!')
-        games = Game.query(Game.user == user.key, Game.game_over == False)
-        return GameForms(games=[game.to_form("") for game in games])
-
-    @endpoints.method(response_message=UserForms,
+        user, games = call_engine(game_engine.user_games, request.user_name)
+        return GameForms(games=[game.to_active_form("", user.name)
+                                for game in games])
+
+    @endpoints.method(request_message=RANKINGS_REQUEST,
+                      response_message=UserForms,
                       path='user/rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
     def get_user_rankings(self, request):
-        """Returns rankings of all Users"""
-        users = User.query()
-        if not users:
+        """Returns a page of Users ranked by their performance. The
+        performance is maintained by Game.end_game, so no scores are read"""
+        users, next_cursor = call_engine(game_engine.rankings,
+                                         request.page_size, request.cursor)
+        if not users and not request.cursor:
             raise endpoints.NotFoundException('No User exists!')
-        for user in users:
-          scores = Score.query(Score.user == user.key).fetch()
-          p = 0
-          if scores:
-            count = len(scores)
-            
-            for score in scores:
-                p += score.score
-            p = p / count
-          user.performance = p
-          user.put()
-
-        users = User.query().order(-User.performance)
-
-        
-        return UserForms(users=[user.to_form() for user in users])
+        return UserForms(users=[user.to_form() for user in users],
+                         next_cursor=next_cursor)
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented
     def make_move(self, request):
         """Makes a move. Returns a game state with message and 
         updates a game's history"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game.game_over:
-            return game.to_form('Game already over!')
-
-        
-        
-        if len(request.guess) != 1 and len(request.guess) != len(game.target):
-            raise endpoints.BadRequestException('Only one letter or the'
-            ' whole word each guess!')
-        game.attempts_remaining -= 1
-        
-        guessresult = False
-        if len(request.guess) == len(game.target):
-          if request.guess.lower() == game.target:
-            guessresult = True
-            newcurrent = request.guess.lower()
-        else:
-          targettem = list(game.target)
-          currenttem = list(game.current)
-          for i in range(len(targettem)):
-              if targettem[i] == request.guess.lower():
-                  currenttem[i] = request.guess.lower()
-                  guessresult = True
-          newcurrent = ""
-          for l in currenttem:
-              newcurrent += l
-
-        
-        game.current = newcurrent
-        game.put()
-
-        if newcurrent == game.target:
-              game.moves.append("made a guess: '{}', result: {}, You win!"
-                .format(request.guess,newcurrent))
-              game.put()
-              game.end_game(True)
-              return game.to_form('You win!')
-
-        if guessresult:
-            game.moves.append("made a guess: '{}', result: {}, Bingo!"
-                .format(request.guess, newcurrent))
-            msg = 'Bingo!'
-        else:
-            game.moves.append("made a guess: '{}', result: {}, You missed!!"
-                .format(request.guess, newcurrent))
-            msg = 'You missed!'
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        game, msg = self._make_move(game_key, request.guess)
+        return game.to_form(msg)
 
-        if game.attempts_remaining < 1:
-            game.end_game(False)
-            return game.to_form(msg + ' Game over!')
+    @staticmethod
+    def _make_move(game_key, guess):
+        """Applies a guess to a Game as a single read-modify-write. The Game,
+        and the Score and User aggregates when the game ends, are committed
+        together. Returns the updated Game and the message for the player"""
+        game, results = HangManApi._make_moves(game_key, [guess])
+        return game, results[0][1]
+
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=MovesResultForm,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @instrumented
+    def make_moves(self, request):
+        """Makes several moves in order, stopping when the game ends. Returns
+        the outcome of each guess made and the final game state"""
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        game, results = self._make_moves(game_key, request.guesses)
+        if results:
+            msg = results[-1][1]
+        elif game.game_over:
+            msg = 'The game is over!'
         else:
-            game.put()
-            return game.to_form(msg)
-
+            msg = 'Time to make a move!'
+        return MovesResultForm(
+            results=[MoveResultForm(guess=guess, message=message,
+                                    currentword=current)
+                     for guess, message, current in results],
+            game=game.to_form(msg))
 
+    @staticmethod
+    def _make_moves(game_key, guesses):
+        """Applies guesses in order to a Game through the game engine, as a
+        single read-modify-write stopping at the end of the game. Returns the
+        updated Game and the guess, message and current word of each guess
+        made"""
+        return call_engine(game_engine.make_moves, game_key.urlsafe(),
+                           guesses)
 
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=SCORES_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return a page of all scores"""
+        scores, next_cursor = call_engine(game_engine.scores,
+                                          request.page_size, request.cursor)
+        return ScoreForms(items=Score.to_forms(scores),
+                          next_cursor=next_cursor)
 
     @endpoints.method(request_message=SCORE_REQUEST,
                       response_message=ScoreForms,
                       path='hightscores',
                       name='get_high_scores',
                       http_method='GET')
+    @instrumented
     def get_high_scores(self, request):
-        """Return highest scores"""
-        scores = Score.query()
-        scores = scores.order(-Score.score)
-
-        if request.limit > 0 :
-          scores = scores.fetch(request.limit)
-
+        """Return a page of the highest scores. limit is kept as an alias of
+        page_size for older clients"""
+        scores, next_cursor = call_engine(game_engine.high_scores,
+                                          request.page_size or request.limit,
+                                          request.cursor)
+        return ScoreForms(items=Score.to_forms(scores),
+                          next_cursor=next_cursor)
 
-        return ScoreForms(items=[score.to_form() for score in scores])    
 
+    @endpoints.method(request_message=LEADERBOARD_REQUEST,
+                      response_message=ScoreForms,
+                      path='leaderboard/{period}',
+                      name='get_leaderboard',
+                      http_method='GET')
+    @instrumented
+    def get_leaderboard(self, request):
+        """Return the top scores of today, this week or all time"""
+        board_ids = Leaderboard.board_ids(date.today())
+        if request.period not in board_ids:
+            raise endpoints.BadRequestException('Period should be one of '
+                '{}!'.format(', '.join(sorted(board_ids))))
+        return ScoreForms(items=Leaderboard.to_forms(
+            board_ids[request.period]))
 
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
         """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
-            raise endpoints.NotFoundException(
-                    'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        user, scores = call_engine(game_engine.user_scores, request.user_name)
+        return ScoreForms(items=[score.to_form(user.name)
+                                 for score in scores])
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_attempts',
                       name='get_average_attempts_remaining',
                       http_method='GET')
+    @instrumented
     def get_average_attempts(self, request):
-        """Get the cached average moves remaining"""
-        return StringMessage(message=memcache.get(MEMCACHE_MOVES_REMAINING) or '')
-
-    @staticmethod
-    def _cache_average_attempts():
-        """Populates memcache with the average moves remaining of Games"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_attempts_remaining = sum([game.attempts_remaining
-                                        for game in games])
-            average = float(total_attempts_remaining)/count
-            memcache.set(MEMCACHE_MOVES_REMAINING,
-                         'The average moves remaining is {:.2f}'.format(average))
+        """Get the average moves remaining, from the active games counter
+        whose totals memcache keeps current on every update"""
+        average = game_engine.average_attempts()
+        if average is None:
+            return StringMessage(message='')
+        return StringMessage(message=AVERAGE_ATTEMPTS_MESSAGE.format(average))
 
 
 api = endpoints.api_server([HangManApi])
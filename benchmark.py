@@ -0,0 +1,558 @@
+#!/usr/bin/env python
+
+"""benchmark.py - Drives the HangManApi endpoints and the main.py handlers
+against the App Engine testbed stubs (in-memory datastore, memcache, taskqueue
+and mail) and reports, for each of them, the latency and the RPCs, entity reads
+and entity writes per call. Runs offline with only the App Engine SDK:
+
+    python benchmark.py --sdk ~/google-cloud-sdk/platform/google_appengine \\
+        --users 10000 --games 20000 --scores 1000000
+
+With --engine memory it instead drives the game engine on the in-memory
+repository, which needs no SDK, and --engine ndb does the same on the ndb
+repository, to compare the storage backends.
+
+With --startup it instead measures, in a new process per run, how long each
+entry point of app.yaml takes to import and to serve its first request.
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import string
+import subprocess
+import sys
+import time
+from datetime import date, timedelta
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+SEED_BATCH_SIZE = 500
+
+
+def setup_sdk(sdk_path):
+    """Puts the App Engine SDK and its bundled libraries on sys.path"""
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+
+
+def activate_testbed():
+    """Activates the testbed with the stubs of every service the app uses"""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=APP_DIR)
+    bed.init_mail_stub()
+    bed.init_app_identity_stub()
+    return bed
+
+
+# The WSGI applications app.yaml routes to, and a cheap first request for each
+ENTRY_POINTS = {
+    'api.api': ('/_ah/spi/HangManApi.get_average_attempts', 'POST', '{}'),
+    'main.app': ('/tasks/cache_average_attempts', 'POST', ''),
+}
+
+
+def measure_startup(entry_point):
+    """Imports entry_point and sends it its first request, like a new
+    instance does. Must run in a fresh process so nothing is imported yet"""
+    import webob
+    bed = activate_testbed()
+    try:
+        module_name, app_name = entry_point.split('.')
+        preloaded = set(sys.modules)
+        start = time.time()
+        app = getattr(__import__(module_name), app_name)
+        imported = time.time()
+        path, method, body = ENTRY_POINTS[entry_point]
+        request = webob.Request.blank(path, method=method, body=body,
+                                      content_type='application/json')
+        status = request.get_response(app).status_int
+        done = time.time()
+        return {'name': entry_point,
+                'import_ms': 1000 * (imported - start),
+                'first_request_ms': 1000 * (done - imported),
+                'status': status,
+                'modules_imported': len(set(sys.modules) - preloaded),
+                'loads_endpoints': 'endpoints' in sys.modules}
+    finally:
+        bed.deactivate()
+
+
+def run_startup(sdk, runs):
+    """Measures every entry point's startup runs times, each in a new
+    process. Returns one dict per entry point with the median timings"""
+    results = []
+    for entry_point in sorted(ENTRY_POINTS):
+        samples = []
+        for _ in range(runs):
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--sdk', sdk,
+                 '--startup-child', entry_point])
+            samples.append(json.loads(output.splitlines()[-1]))
+        row = samples[len(samples) // 2]
+        for field in ('import_ms', 'first_request_ms'):
+            row[field] = sorted(sample[field]
+                                for sample in samples)[len(samples) // 2]
+        row['runs'] = runs
+        results.append(row)
+    return results
+
+
+def report_startup(rows, as_json=False):
+    if as_json:
+        print json.dumps(rows, indent=2, sort_keys=True)
+        return
+    print '{:<12}{:>6}{:>12}{:>16}{:>9}{:>9}{:>11}'.format(
+        'entry point', 'runs', 'import ms', 'first req ms', 'status',
+        'modules', 'endpoints')
+    for row in rows:
+        print '{name:<12}{runs:>6}{import_ms:>12.1f}{first_request_ms:>16.1f}' \
+              '{status:>9}{modules_imported:>9}' \
+              '{loads_endpoints!s:>11}'.format(**row)
+
+
+class RpcStats(object):
+    """Counts the API calls and the datastore entity reads and writes made
+    while its hooks are installed"""
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.reads = 0
+        self.writes = 0
+
+    def install(self, apiproxy):
+        apiproxy.GetPreCallHooks().Append('benchmark', self.pre_call)
+        apiproxy.GetPostCallHooks().Append('benchmark', self.post_call)
+
+    def snapshot(self):
+        return self.calls.copy(), self.reads, self.writes
+
+    def pre_call(self, service, call, request, response):
+        self.calls['{}.{}'.format(service, call)] += 1
+        if service == 'datastore_v3':
+            if call == 'Put':
+                self.writes += request.entity_size()
+            elif call == 'Delete':
+                self.writes += request.key_size()
+
+    def post_call(self, service, call, request, response):
+        if service == 'datastore_v3':
+            if call == 'Get':
+                self.reads += sum(1 for entity in response.entity_list()
+                                  if entity.has_entity())
+            elif call in ('RunQuery', 'Next'):
+                self.reads += response.result_size()
+
+
+class Measurement(object):
+    """Latencies and per call RPC counts of one endpoint or handler"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.calls = collections.Counter()
+        self.reads = 0
+        self.writes = 0
+        self.errors = 0
+
+    def percentile(self, fraction):
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1,
+                             int(fraction * len(latencies)))]
+
+    def to_dict(self):
+        count = len(self.latencies) or 1
+        return {'name': self.name,
+                'count': len(self.latencies),
+                'errors': self.errors,
+                'p50_ms': 1000 * self.percentile(0.5),
+                'p99_ms': 1000 * self.percentile(0.99),
+                'rpcs_per_call': float(sum(self.calls.values())) / count,
+                'reads_per_call': float(self.reads) / count,
+                'writes_per_call': float(self.writes) / count,
+                'rpcs': dict((call, float(n) / count)
+                             for call, n in self.calls.iteritems())}
+
+
+class Benchmark(object):
+    """Seeds the testbed and measures the endpoints and handlers"""
+
+    def __init__(self, args):
+        from google.appengine.api import apiproxy_stub_map
+        from google.appengine.ext import testbed as testbed_module
+
+        self.args = args
+        self.testbed = activate_testbed()
+        self.taskqueue = self.testbed.get_stub(
+            testbed_module.TASKQUEUE_SERVICE_NAME)
+        self.stats = RpcStats()
+        self.stats.install(apiproxy_stub_map.apiproxy)
+        self.results = []
+
+        import api
+        import main
+        import tasks
+        self.api = api
+        self.main = main
+        self.tasks = tasks
+        self.service = api.HangManApi()
+        self.game_keys = []
+        self.user_names = []
+
+    def seed(self):
+        """Writes the configured numbers of Users, active Games and Scores
+        directly, bypassing the endpoints"""
+        from google.appengine.ext import ndb
+        from models import User, UserName, Game, Score, ActiveGames
+        from word import dictionary, mask
+
+        args = self.args
+        self.user_names = ['user{}'.format(i) for i in range(args.users)]
+        totals = collections.defaultdict(lambda: [0, 0])
+        batch = []
+        for i in range(args.scores):
+            user_id = random.randint(1, args.users)
+            points = random.choice([0, random.randint(5, 30)])
+            totals[user_id][0] += 1
+            totals[user_id][1] += points
+            batch.append(Score(user=ndb.Key(User, user_id),
+                               user_name=self.user_names[user_id - 1],
+                               date=date.today() - timedelta(
+                                   days=random.randint(0, 13)),
+                               won=points > 0, score=points))
+            batch = self._flush(batch)
+
+        for i, name in enumerate(self.user_names):
+            games_played, total_score = totals[i + 1]
+            user = User(id=i + 1, name=name,
+                        email='{}@example.com'.format(name),
+                        games_played=games_played, total_score=total_score,
+                        performance=(float(total_score) / games_played
+                                     if games_played else 0.0))
+            batch.append(user)
+            batch.append(UserName(id=UserName.normalize(name), user=user.key))
+            batch = self._flush(batch)
+        ndb.put_multi(batch)
+
+        batch = []
+        attempts_remaining = 0
+        for i in range(args.games):
+            user_id = random.randint(1, args.users)
+            target = dictionary.choice()
+            attempts = random.randint(1, 14)
+            attempts_remaining += attempts
+            batch.append(Game(user=ndb.Key(User, user_id),
+                              user_name=self.user_names[user_id - 1],
+                              target=target, current=mask(target),
+                              attempts_allowed=attempts,
+                              attempts_remaining=attempts))
+            if len(batch) >= SEED_BATCH_SIZE:
+                self.game_keys.extend(ndb.put_multi(batch))
+                batch = []
+        self.game_keys.extend(ndb.put_multi(batch))
+        ActiveGames.reset(args.games, attempts_remaining)
+        self.tasks.rollup_leaderboards()
+        self._clear_caches()
+
+    @staticmethod
+    def _flush(batch):
+        from google.appengine.ext import ndb
+        if len(batch) >= SEED_BATCH_SIZE:
+            ndb.put_multi(batch)
+            return []
+        return batch
+
+    @staticmethod
+    def _clear_caches():
+        """Every measured call starts like a new request"""
+        from google.appengine.ext import ndb
+        ndb.get_context().clear_cache()
+
+    def measure(self, name, call, runs=None):
+        """Runs call(i) runs times and records its latency and RPCs"""
+        measurement = Measurement(name)
+        for i in range(runs or self.args.runs):
+            self._clear_caches()
+            calls, reads, writes = self.stats.snapshot()
+            start = time.time()
+            try:
+                call(i)
+            except Exception:
+                measurement.errors += 1
+            measurement.latencies.append(time.time() - start)
+            measurement.calls.update(self.stats.calls - calls)
+            measurement.reads += self.stats.reads - reads
+            measurement.writes += self.stats.writes - writes
+        self.results.append(measurement)
+        return measurement
+
+    def request(self, container, **fields):
+        return container.combined_message_class(**fields)
+
+    def run_tasks(self, url):
+        """Runs and removes the queued tasks for url, like the task queue"""
+        tasks = self.taskqueue.get_filtered_tasks(url=url)
+        for task in tasks:
+            self.taskqueue.DeleteTask('default', task.name)
+        for task in tasks:
+            self.main.app.get_response(task.url, method='POST',
+                                       body=task.payload,
+                                       headers=dict(task.headers))
+
+    def run(self):
+        from protorpc import message_types
+
+        api = self.api
+        service = self.service
+        user_name = lambda i: random.choice(self.user_names)
+        game_key = lambda i: random.choice(self.game_keys).urlsafe()
+        new_games = []
+
+        self.measure('create_user', lambda i: service.create_user(
+            self.request(api.USER_REQUEST, user_name='bench{}'.format(i))))
+        self.measure('new_game', lambda i: new_games.append(service.new_game(
+            self.request(api.NEW_GAME_REQUEST, user_name=user_name(i),
+                         attempts=14)).urlsafe_key))
+        self.measure('get_game', lambda i: service.get_game(
+            self.request(api.GAME_STATE_REQUEST,
+                         urlsafe_game_key=game_key(i))))
+        # A client polling a game it already has the current version of
+        known_games = [(key, service.get_game(self.request(
+            api.GAME_STATE_REQUEST, urlsafe_game_key=key)).version)
+            for key in (game_key(i) for i in range(self.args.runs))]
+        self.measure('get_game not_modified', lambda i: service.get_game(
+            self.request(api.GAME_STATE_REQUEST,
+                         urlsafe_game_key=known_games[i][0],
+                         if_version=known_games[i][1])))
+        self.measure('make_move', lambda i: service.make_move(
+            self.request(api.MAKE_MOVE_REQUEST,
+                         urlsafe_game_key=new_games[i % len(new_games)],
+                         guess=random.choice(string.ascii_lowercase))))
+        self.measure('get_game_history', lambda i: service.get_game_history(
+            self.request(api.HISTORY_REQUEST,
+                         urlsafe_game_key=new_games[i % len(new_games)])))
+        self.measure('get_user_games', lambda i: service.get_user_games(
+            self.request(api.USER_REQUEST, user_name=user_name(i))))
+        self.measure('get_user_scores', lambda i: service.get_user_scores(
+            self.request(api.USER_REQUEST, user_name=user_name(i))))
+        self.measure('get_scores', lambda i: service.get_scores(
+            self.request(api.SCORES_REQUEST)))
+        self.measure('get_high_scores', lambda i: service.get_high_scores(
+            self.request(api.SCORE_REQUEST)))
+        self.measure('get_user_rankings', lambda i: service.get_user_rankings(
+            self.request(api.RANKINGS_REQUEST)))
+        self.measure('get_leaderboard', lambda i: service.get_leaderboard(
+            self.request(api.LEADERBOARD_REQUEST, period='weekly')))
+        self.measure('get_average_attempts',
+                     lambda i: service.get_average_attempts(
+                         message_types.VoidMessage()))
+        self.measure('cancel_game', lambda i: service.cancel_game(
+            self.request(api.GET_GAME_REQUEST,
+                         urlsafe_game_key=new_games[i % len(new_games)])))
+
+        self.measure('/tasks/cache_average_attempts',
+                     lambda i: self.main.app.get_response(
+                         '/tasks/cache_average_attempts', method='POST'))
+        self.measure('/crons/send_reminder', self.send_reminder, runs=1)
+
+    def send_reminder(self, i):
+        """The reminder cron and every task it queues"""
+        self.main.app.get_response('/crons/send_reminder')
+        while self.taskqueue.get_filtered_tasks(url='/tasks/plan_reminders'):
+            self.run_tasks('/tasks/plan_reminders')
+        self.run_tasks('/tasks/send_reminder')
+
+    def report(self, as_json=False):
+        report(self.results, as_json)
+
+    def close(self):
+        self.testbed.deactivate()
+
+
+def report(results, as_json=False):
+    rows = [result.to_dict() for result in results]
+    if as_json:
+        print json.dumps(rows, indent=2, sort_keys=True)
+        return
+    print '{:<32}{:>6}{:>7}{:>10}{:>10}{:>8}{:>8}{:>8}'.format(
+        'endpoint', 'runs', 'errors', 'p50 ms', 'p99 ms', 'rpcs',
+        'reads', 'writes')
+    for row in rows:
+        print '{name:<32}{count:>6}{errors:>7}{p50_ms:>10.2f}' \
+              '{p99_ms:>10.2f}{rpcs_per_call:>8.1f}' \
+              '{reads_per_call:>8.1f}{writes_per_call:>8.1f}'.format(**row)
+
+
+class EngineBenchmark(object):
+    """Drives the game engine (engine.py) directly against a repository:
+    the in-memory one, which needs no SDK, or the ndb one on the testbed.
+    Users and Games are created through the engine itself"""
+
+    NEW_GAMES_BATCH_SIZE = 50
+
+    def __init__(self, args):
+        from engine import GameEngine
+        self.args = args
+        self.testbed = None
+        self.stats = None
+        if args.engine == 'ndb':
+            from google.appengine.api import apiproxy_stub_map
+            self.testbed = activate_testbed()
+            self.stats = RpcStats()
+            self.stats.install(apiproxy_stub_map.apiproxy)
+            from ndb_repository import NdbRepository
+            repository = NdbRepository()
+        else:
+            from repository import MemoryRepository
+            repository = MemoryRepository()
+        self.engine = GameEngine(repository)
+        self.game_ids = []
+        self.user_names = []
+        self.results = []
+
+    def seed(self):
+        args = self.args
+        self.user_names = ['user{}'.format(i) for i in range(args.users)]
+        for name in self.user_names:
+            self.engine.create_user(name, '{}@example.com'.format(name))
+        remaining = args.games
+        while remaining > 0:
+            count = min(remaining, self.NEW_GAMES_BATCH_SIZE)
+            games = self.engine.new_games(random.choice(self.user_names),
+                                          random.randint(1, 14), count)
+            self.game_ids.extend(self.engine.repository.game_id(game)
+                                 for game in games)
+            remaining -= count
+        self._clear_caches()
+
+    def _clear_caches(self):
+        if self.testbed:
+            Benchmark._clear_caches()
+
+    def measure(self, name, call, runs=None):
+        """Runs call(i) runs times and records its latency, and its RPCs
+        on the ndb repository"""
+        measurement = Measurement(name)
+        for i in range(runs or self.args.runs):
+            self._clear_caches()
+            if self.stats:
+                calls, reads, writes = self.stats.snapshot()
+            start = time.time()
+            try:
+                call(i)
+            except Exception:
+                measurement.errors += 1
+            measurement.latencies.append(time.time() - start)
+            if self.stats:
+                measurement.calls.update(self.stats.calls - calls)
+                measurement.reads += self.stats.reads - reads
+                measurement.writes += self.stats.writes - writes
+        self.results.append(measurement)
+        return measurement
+
+    def run(self):
+        engine = self.engine
+        user_name = lambda i: random.choice(self.user_names)
+        game_id = lambda i: random.choice(self.game_ids)
+        new_game_ids = []
+
+        self.measure('create_user', lambda i: engine.create_user(
+            'bench{}'.format(i)))
+        self.measure('new_games', lambda i: new_game_ids.extend(
+            engine.repository.game_id(game)
+            for game in engine.new_games(user_name(i), 14)))
+        self.measure('new_games x10', lambda i: engine.new_games(
+            user_name(i), 14, 10))
+        self.measure('get_game', lambda i: engine.get_game(game_id(i)))
+        self.measure('get_games x20', lambda i: engine.get_games(
+            [game_id(i) for _ in range(20)]))
+        self.measure('make_moves', lambda i: engine.make_moves(
+            new_game_ids[i % len(new_game_ids)],
+            [random.choice(string.ascii_lowercase)]))
+        self.measure('make_moves x5', lambda i: engine.make_moves(
+            game_id(i), random.sample(string.ascii_lowercase, 5)))
+        self.measure('user_games', lambda i: engine.user_games(user_name(i)))
+        self.measure('user_scores', lambda i: engine.user_scores(
+            user_name(i)))
+        self.measure('scores', lambda i: engine.scores())
+        self.measure('high_scores', lambda i: engine.high_scores())
+        self.measure('rankings', lambda i: engine.rankings())
+        self.measure('average_attempts', lambda i: engine.average_attempts())
+        self.measure('cancel_game', lambda i: engine.cancel_game(
+            new_game_ids[i % len(new_game_ids)]))
+
+    def report(self, as_json=False):
+        report(self.results, as_json)
+
+    def close(self):
+        if self.testbed:
+            self.testbed.deactivate()
+
+
+def run_benchmark(benchmark, args):
+    try:
+        benchmark.seed()
+        benchmark.run()
+        benchmark.report(args.json)
+    finally:
+        benchmark.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path of the App Engine SDK (google_appengine)')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--games', type=int, default=2000)
+    parser.add_argument('--scores', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=100,
+                        help='calls measured per endpoint')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed, for comparable runs')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('--startup', action='store_true',
+                        help='measure the import and first request latency '
+                             'of each entry point instead, --runs times')
+    parser.add_argument('--startup-child', choices=sorted(ENTRY_POINTS),
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--engine', choices=['memory', 'ndb'],
+                        help='drive the game engine directly, against the '
+                             'in-memory repository, which needs no SDK, or '
+                             'the ndb one, instead of the endpoints')
+    args = parser.parse_args()
+    random.seed(args.seed)
+    if args.engine == 'memory':
+        sys.path.insert(0, APP_DIR)
+        run_benchmark(EngineBenchmark(args), args)
+        return
+    if not args.sdk:
+        parser.error('pass --sdk or set APPENGINE_SDK')
+
+    if args.startup:
+        report_startup(run_startup(args.sdk, args.runs), args.json)
+        return
+    setup_sdk(args.sdk)
+    if args.startup_child:
+        print json.dumps(measure_startup(args.startup_child))
+        return
+
+    if args.engine == 'ndb':
+        run_benchmark(EngineBenchmark(args), args)
+    else:
+        run_benchmark(Benchmark(args), args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""cache.py - Read-through cache for entities fetched by key. Reads check a
+small per-instance LRU first, then memcache, then the datastore. Models opt in
+by extending CachedModel, whose put and delete hooks invalidate the cache."""
+
+import collections
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+LOCAL_CACHE_SIZE = 1000
+MEMCACHE_PREFIX = 'ENTITY:'
+# After a write memcache refuses to be refilled for this many seconds, so a
+# read racing the write cannot put the old entity back
+INVALIDATION_LOCK_SECONDS = 1
+
+_local = collections.OrderedDict()
+_lock = threading.Lock()
+_stats = collections.Counter()
+
+
+class CachedModel(ndb.Model):
+    """Base class of the models served through the entity cache"""
+    # Set to False on a subclass to read it straight from the datastore
+    _use_entity_cache = True
+    # Seconds an entity is served from the instance without checking
+    # memcache. Other instances' writes can be missed for this long
+    _local_cache_ttl = 1
+    # Seconds an entity stays in memcache
+    _memcache_ttl = 600
+    # memcache is managed here rather than by ndb
+    _use_memcache = False
+
+    def _post_put_hook(self, future):
+        invalidate(self.key)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        invalidate(key)
+
+
+def get(key, model):
+    """Returns the entity the key points to, or None if it does not exist"""
+    return get_multi([key], model)[0]
+
+
+def get_multi(keys, model):
+    """Returns the entities the keys point to, with None for those that do
+    not exist. Each layer is read once for all the keys it misses"""
+    if not getattr(model, '_use_entity_cache', False):
+        return ndb.get_multi(keys)
+    cache_keys = [key.urlsafe() for key in keys]
+    now = time.time()
+    encoded = {}
+    with _lock:
+        for cache_key in cache_keys:
+            entry = _local.pop(cache_key, None)
+            if entry and entry[1] > now:
+                _local[cache_key] = entry
+                encoded[cache_key] = entry[0]
+        _stats['local_hits'] += len(encoded)
+
+    missing = [cache_key for cache_key in cache_keys
+               if cache_key not in encoded]
+    if missing:
+        cached = memcache.get_multi(missing, key_prefix=MEMCACHE_PREFIX)
+        _count('memcache_hits', len(cached))
+        _count('misses', len(missing) - len(cached))
+        missing = [cache_key for cache_key in missing
+                   if cache_key not in cached]
+        entities = ndb.get_multi([ndb.Key(urlsafe=cache_key)
+                                  for cache_key in missing])
+        for cache_key, entity in zip(missing, entities):
+            if entity:
+                cached[cache_key] = entity._to_pb().Encode()
+        memcache.add_multi(dict((cache_key, cached[cache_key])
+                                for cache_key in missing
+                                if cache_key in cached),
+                           time=model._memcache_ttl,
+                           key_prefix=MEMCACHE_PREFIX)
+        encoded.update(cached)
+        with _lock:
+            for cache_key, value in cached.iteritems():
+                _local[cache_key] = (value, now + model._local_cache_ttl)
+            while len(_local) > LOCAL_CACHE_SIZE:
+                _local.popitem(last=False)
+
+    return [_decode(encoded[cache_key]) if cache_key in encoded else None
+            for cache_key in cache_keys]
+
+
+def invalidate(key):
+    """Drops the entity from the caches once the current transaction, if
+    any, commits"""
+    ndb.get_context().call_on_commit(lambda: _invalidate(key))
+
+
+def _invalidate(key):
+    cache_key = key.urlsafe()
+    with _lock:
+        _local.pop(cache_key, None)
+    memcache.delete(MEMCACHE_PREFIX + cache_key,
+                    seconds=INVALIDATION_LOCK_SECONDS)
+    _count('invalidations')
+
+
+def _decode(encoded):
+    """Every read gets its own entity, so callers may modify it"""
+    return ndb.ModelAdapter().pb_to_entity(entity_pb.EntityProto(encoded))
+
+
+def _count(name, n=1):
+    with _lock:
+        _stats[name] += n
+
+
+def get_stats():
+    """Returns this instance's cache hit, miss and invalidation counts"""
+    with _lock:
+        return dict(_stats)
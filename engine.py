@@ -0,0 +1,240 @@
+"""engine.py - The rules of Hangman, and a game engine that plays them against
+a repository (see repository.py) for storage. Nothing here imports App Engine,
+so with the in-memory repository the engine runs on any Python 2.7."""
+
+import struct
+import time
+
+from word import dictionary, mask, apply_guess
+
+# Packed move record: timestamp, flags and guess length, then the guess
+MOVE_HEADER = struct.Struct('>IBB')
+MOVE_HIT = 1
+
+MAX_ATTEMPTS = 14
+
+
+class NotFoundError(LookupError):
+    """The User or Game asked for does not exist"""
+
+
+class ConflictError(ValueError):
+    """The User name is already taken"""
+
+
+class BadRequestError(ValueError):
+    """The request is not allowed by the rules"""
+
+
+def normalize_name(name):
+    """Returns the form of a User name that must be unique"""
+    return name.strip().lower()
+
+
+def score_points(target, attempts_remaining, won):
+    """Returns the score of a finished game"""
+    if won:
+        return len(target) + MAX_ATTEMPTS - attempts_remaining
+    return 0
+
+
+def pack_move(guess, hit, timestamp=None):
+    """Packs a move into a few bytes"""
+    guess = guess.encode('utf-8')
+    if timestamp is None:
+        timestamp = time.time()
+    return MOVE_HEADER.pack(int(timestamp), MOVE_HIT if hit else 0,
+                            len(guess)) + guess
+
+
+def unpack_moves(history):
+    """Yields the (timestamp, hit, guess) tuples packed in history"""
+    offset = 0
+    while offset < len(history or ''):
+        timestamp, flags, length = MOVE_HEADER.unpack_from(history, offset)
+        offset += MOVE_HEADER.size
+        guess = history[offset:offset + length].decode('utf-8')
+        offset += length
+        yield timestamp, bool(flags & MOVE_HIT), guess
+
+
+def move_message(guess, result, hit, target):
+    """Returns the history message of a move"""
+    if result == target:
+        outcome = 'You win!'
+    elif hit:
+        outcome = 'Bingo!'
+    else:
+        outcome = 'You missed!!'
+    # Guesses are unicode, so the message is too
+    return u"made a guess: '{}', result: {}, {}".format(guess, result,
+                                                        outcome)
+
+
+def record_move(game, guess, hit):
+    """Records a guess whose result is already in game.current"""
+    if game.moves:
+        game.moves.append(move_message(guess, game.current, hit,
+                                       game.target))
+    else:
+        game.history = (game.history or '') + pack_move(guess, hit)
+
+
+def render_moves(game, creator_name, offset=0, limit=None):
+    """Returns the history of the game as messages, replaying the packed
+    guesses against the target to recover each result"""
+    if game.moves:
+        messages = list(game.moves)
+    else:
+        messages = [u'{} created a new game'.format(creator_name)]
+        current = mask(game.target)
+        for timestamp, hit, guess in unpack_moves(game.history):
+            current, _ = apply_guess(game.target, current, guess)
+            messages.append(move_message(guess, current, hit, game.target))
+    offset = offset or 0
+    if limit:
+        return messages[offset:offset + limit]
+    return messages[offset:]
+
+
+def apply_move(game, guess):
+    """Applies a guess to an active game without writing it. Returns the
+    message for the player and, if the guess ended the game, whether the
+    player won, else None"""
+    if len(guess) != 1 and len(guess) != len(game.target):
+        raise BadRequestError('Only one letter or the whole word each guess!')
+    game.attempts_remaining -= 1
+
+    current, hit = apply_guess(game.target, game.current, guess)
+    game.current = current
+    record_move(game, guess, hit)
+
+    if current == game.target:
+        return 'You win!', True
+    msg = 'Bingo!' if hit else 'You missed!'
+    if game.attempts_remaining < 1:
+        return msg + ' Game over!', False
+    return msg, None
+
+
+class GameEngine(object):
+    """Plays Hangman for Users, storing the Users, Games and Scores in a
+    repository"""
+
+    def __init__(self, repository):
+        self.repository = repository
+
+    def create_user(self, name, email=None):
+        user = self.repository.create_user(name, email)
+        if not user:
+            raise ConflictError('A User with that name already exists!')
+        return user
+
+    def get_user(self, name):
+        user = self.repository.get_user(name)
+        if not user:
+            raise NotFoundError('A User with that name does not exist!')
+        return user
+
+    def new_games(self, user_name, attempts=5, count=1):
+        """Creates count games for a User, with one write for all of them"""
+        if 1 > attempts or attempts > MAX_ATTEMPTS:
+            raise BadRequestError('Attempts should not be less than 1 or '
+                                  'greater than {}!'.format(MAX_ATTEMPTS))
+        user = self.get_user(user_name)
+        words = [dictionary.choice() for _ in range(count)]
+        return self.repository.new_games(user, attempts,
+                                         [(word, mask(word))
+                                          for word in words])
+
+    def get_game(self, game_id):
+        game = self.repository.get_games([game_id])[0]
+        if not game:
+            raise NotFoundError('Game not found!')
+        return game
+
+    def get_games(self, game_ids):
+        """Returns the games that exist among game_ids, read at once"""
+        return [game for game in self.repository.get_games(game_ids)
+                if game]
+
+    def make_moves(self, game_id, guesses):
+        """Applies guesses in order to a game as a single read-modify-write,
+        stopping at the end of the game. The game, and the Score and User
+        aggregates when the game ends, are committed together. Returns the
+        updated game and the guess, message and current word of each guess
+        made"""
+        return self.repository.transaction(self._make_moves, game_id,
+                                           guesses)
+
+    def _make_moves(self, game_id, guesses):
+        game = self.repository.get_game_for_update(game_id)
+        if not game:
+            raise NotFoundError('Game not found!')
+        if game.game_over:
+            return game, [(guess, 'Game already over!', game.current)
+                          for guess in guesses[:1]]
+        if not guesses:
+            return game, []
+
+        attempts_remaining = game.attempts_remaining
+        results = []
+        won = None
+        for guess in guesses:
+            message, won = apply_move(game, guess)
+            results.append((guess, message, game.current))
+            if won is not None:
+                break
+        if results:
+            self.repository.update_active_games(
+                0, game.attempts_remaining - attempts_remaining)
+        if won is None:
+            self.repository.save_game(game)
+        else:
+            self.repository.end_game(game, won)
+        return game, results
+
+    def cancel_game(self, game_id):
+        """Deletes an active game. The game is re-read in the transaction
+        that deletes it, so a game ended meanwhile is never cancelled"""
+        self.repository.transaction(self._cancel_game, game_id)
+
+    def _cancel_game(self, game_id):
+        game = self.repository.get_game_for_update(game_id)
+        if not game:
+            raise NotFoundError('Game not found!')
+        if game.game_over:
+            raise BadRequestError('Game already over!')
+        self.repository.delete_game(game)
+
+    def user_games(self, user_name):
+        """Returns a User and its active games"""
+        user = self.get_user(user_name)
+        return user, self.repository.user_games(user)
+
+    def user_scores(self, user_name):
+        """Returns a User and its Scores"""
+        user = self.get_user(user_name)
+        return user, self.repository.user_scores(user)
+
+    def scores(self, page_size=None, cursor=None):
+        """Returns a page of Scores and the cursor of the next page"""
+        return self.repository.scores(page_size, cursor)
+
+    def high_scores(self, page_size=None, cursor=None):
+        """Returns a page of Scores from the highest and the cursor of the
+        next page"""
+        return self.repository.high_scores(page_size, cursor)
+
+    def rankings(self, page_size=None, cursor=None):
+        """Returns a page of Users by performance and the cursor of the next
+        page"""
+        return self.repository.rankings(page_size, cursor)
+
+    def average_attempts(self):
+        """Returns the average attempts remaining of the active games, or
+        None if there are none"""
+        count, attempts_remaining = self.repository.active_totals()
+        if count > 0:
+            return float(attempts_remaining) / count
+        return None
@@ -0,0 +1,141 @@
+"""instrumentation.py - Measures the endpoints and the task and cron handlers:
+wall time, datastore RPCs by type, memcache hits and misses and task queue
+enqueues. Each sampled or slow request is logged as a JSON record and all of
+them are added to per instance totals served by /admin/metrics."""
+
+import collections
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import webapp2
+import webob.exc
+from google.appengine.api import apiproxy_stub_map
+
+# Fraction of the requests whose API calls are counted and logged
+SAMPLE_RATE = float(os.environ.get('INSTRUMENTATION_SAMPLE_RATE', 1))
+# Requests slower than this are always logged, as warnings
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 1000))
+
+DATASTORE_CALLS = {'Get': 'datastore_get',
+                   'RunQuery': 'datastore_query',
+                   'Next': 'datastore_query',
+                   'Put': 'datastore_put',
+                   'Delete': 'datastore_delete'}
+
+_local = threading.local()
+_lock = threading.Lock()
+_totals = collections.defaultdict(collections.Counter)
+_slowest = collections.defaultdict(float)
+
+
+def _pre_call(service, call, request, response):
+    counts = getattr(_local, 'counts', None)
+    if counts is None:
+        return
+    if service == 'datastore_v3':
+        counts[DATASTORE_CALLS.get(call, 'datastore_other')] += 1
+    elif service == 'taskqueue' and call == 'BulkAdd':
+        counts['taskqueue_enqueues'] += request.add_request_size()
+
+
+def _post_call(service, call, request, response):
+    counts = getattr(_local, 'counts', None)
+    if counts is None:
+        return
+    if service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        counts['memcache_hits'] += hits
+        counts['memcache_misses'] += request.key_size() - hits
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('instrumentation',
+                                                     _pre_call)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('instrumentation',
+                                                      _post_call)
+
+
+def _start():
+    """Starts measuring a request on this thread, counting its API calls if
+    it is sampled"""
+    if random.random() < SAMPLE_RATE:
+        _local.counts = collections.Counter()
+    else:
+        _local.counts = None
+    return time.time()
+
+
+def _finish(name, start, status):
+    wall_ms = (time.time() - start) * 1000
+    counts = _local.counts
+    _local.counts = None
+    with _lock:
+        totals = _totals[name]
+        totals['requests'] += 1
+        totals['wall_ms'] += wall_ms
+        if counts is not None:
+            totals['sampled'] += 1
+            totals.update(counts)
+        _slowest[name] = max(_slowest[name], wall_ms)
+
+    slow = wall_ms >= SLOW_REQUEST_MS
+    if counts is not None or slow:
+        record = dict(counts or {})
+        record.update(name=name, status=status, wall_ms=round(wall_ms, 1),
+                      sampled=counts is not None)
+        log = logging.warning if slow else logging.info
+        log('request_stats %s', json.dumps(record, sort_keys=True))
+
+
+def instrumented(method):
+    """Measures an endpoints method. Goes below @endpoints.method"""
+    @functools.wraps(method)
+    def instrumented_method(service, request):
+        start = _start()
+        status = 'OK'
+        try:
+            return method(service, request)
+        except Exception, e:
+            status = e.__class__.__name__
+            raise
+        finally:
+            _finish(method.__name__, start, status)
+    return instrumented_method
+
+
+class InstrumentedHandler(webapp2.RequestHandler):
+    """RequestHandler whose requests are measured"""
+
+    def dispatch(self):
+        start = _start()
+        status = None
+        try:
+            super(InstrumentedHandler, self).dispatch()
+        except Exception, e:
+            # The response is only given the error's status once the
+            # exception reaches the application, after this returns
+            if isinstance(e, webob.exc.HTTPException):
+                status = e.code
+            else:
+                status = 500
+            raise
+        finally:
+            _finish(self.request.path, start,
+                    status or self.response.status_int)
+
+
+def get_metrics():
+    """Returns this instance's totals for every endpoint and handler. API
+    call counts only cover the sampled requests"""
+    with _lock:
+        metrics = {}
+        for name, totals in _totals.iteritems():
+            metrics[name] = dict(totals)
+            metrics[name]['mean_wall_ms'] = (totals['wall_ms'] /
+                                             totals['requests'])
+            metrics[name]['max_wall_ms'] = _slowest[name]
+        return metrics
@@ -2,23 +2,103 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import hashlib
+import json
 import logging
+from datetime import date, datetime
 
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import HangManApi
+from google.appengine.api import datastore_errors, taskqueue
+from google.appengine.ext import ndb
 
-from models import User
-from models import Game
+import tasks
+import transfer
+from models import User, Game, Score
+from models import Migration, ReminderRun, ReminderShard
+from utils import fetch_page, get_coalesced_task_stats
+from instrumentation import InstrumentedHandler, get_metrics
+import cache
 
-class SendReminderEmail(webapp2.RequestHandler):
+# Users emailed by each reminder task
+REMINDER_SHARD_SIZE = 100
+
+def queue_reminder_planning(run):
+    """Queues the task that plans the next shard of a ReminderRun. It is
+    named after the run's cursor, so each page is planned once"""
+    try:
+        taskqueue.add(name='reminder-plan-{}-{}'.format(
+                          run.key.id(), hashlib.md5(run.cursor or '')
+                          .hexdigest()),
+                      url='/tasks/plan_reminders',
+                      params={'run': run.key.id()})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+class SendReminderEmail(InstrumentedHandler):
     def get(self):
-        """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
+        """Start splitting the Users with active games into shards, each
+        emailed by its own task. The shards are planned by a chain of tasks
+        that checkpoint the cursor, so a rerun resumes after the last queued
+        shard. Called every day using a cron job"""
+        run = ReminderRun.get_or_insert(date.today().isoformat())
+        if not run.done:
+            queue_reminder_planning(run)
+
+
+class PlanReminderShard(InstrumentedHandler):
+    def post(self):
+        """Queue the reminder task of the next shard of Users with active
+        games, checkpoint the cursor and queue the planning of the shard
+        after it"""
+        run = ReminderRun.get_by_id(self.request.get('run'))
+        if run and not run.done:
+            query = Game.query(Game.game_over == False,
+                               projection=[Game.user], distinct=True)
+            games, cursor = fetch_page(query, REMINDER_SHARD_SIZE,
+                                       run.cursor)
+            if games:
+                shard = '{}-{}'.format(run.key.id(), run.shards)
+                try:
+                    taskqueue.add(name='reminder-' + shard,
+                                  url='/tasks/send_reminder',
+                                  params={'shard': shard,
+                                          'users': ','.join(
+                                              game.user.urlsafe()
+                                              for game in games)})
+                except (taskqueue.TaskAlreadyExistsError,
+                        taskqueue.TombstonedTaskError):
+                    pass
+                run.shards += 1
+            run.cursor = cursor
+            run.done = cursor is None
+            run.put()
+            if not run.done:
+                queue_reminder_planning(run)
+        self.response.set_status(204)
+
+
+class SendReminderShard(InstrumentedHandler):
+    def post(self):
+        """Send a reminder email to each User of a shard that has an email
+        about their unfinished games"""
+        # Only the reminder tasks send mail, so the other handlers do not
+        # import it
+        from google.appengine.api import mail, app_identity
         app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
-        for user in users:
-            games = Game.query(Game.user == user.key).filter(Game.game_over == False).fetch()
+        shard = ReminderShard.get_or_insert(self.request.get('shard'))
+        user_keys = [ndb.Key(urlsafe=user_key) for user_key
+                     in self.request.get('users').split(',')]
+        user_keys = user_keys[shard.processed:]
+        users = ndb.get_multi(user_keys)
+        futures = [Game.query(Game.user == user_key,
+                              Game.game_over == False).fetch_async()
+                   for user_key in user_keys]
+        for user, future in zip(users, futures):
+            shard.processed += 1
+            if not user or not user.email:
+                continue
+            games = future.get_result()
             if games:
                 
                     subject = 'This is a reminder!'
@@ -31,16 +111,234 @@ class SendReminderEmail(webapp2.RequestHandler):
                                    user.email,
                                    subject,
                                    body)
+                    shard.put()
+        shard.put()
+        self.response.set_status(204)
 
 
-class UpdateAverageMovesRemaining(webapp2.RequestHandler):
+class UpdateAverageMovesRemaining(InstrumentedHandler):
     def post(self):
         """Update game listing announcement in memcache."""
-        HangManApi._cache_average_attempts()
+        tasks.cache_average_attempts()
+        self.response.set_status(204)
+
+
+class ReconcileActiveGames(InstrumentedHandler):
+    def get(self):
+        """Correct any drift of the active games counter by recounting the
+        active Games. Called every day using a cron job"""
+        tasks.reconcile_active_games()
+
+
+class RollupLeaderboards(InstrumentedHandler):
+    def get(self):
+        """Rebuild the daily, weekly and all-time leaderboards from the
+        Scores. Called every hour using a cron job"""
+        tasks.rollup_leaderboards()
+
+
+class StartRebuildUserRankings(InstrumentedHandler):
+    def get(self):
+        """Start recomputing every User's score aggregates from the stored
+        Scores. Called every week using a cron job, and with the migration
+        parameter every day until the Users that predate the aggregates
+        have been rebuilt once, starting at most one rebuild a day"""
+        if not self.request.get('migration'):
+            taskqueue.add(url='/tasks/rebuild_rankings')
+            return
+        if Migration.is_done(Migration.RANKINGS):
+            return
+        try:
+            taskqueue.add(name='rebuild-rankings-' + date.today().isoformat(),
+                          url='/tasks/rebuild_rankings')
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+
+class RebuildUserRankings(InstrumentedHandler):
+    def post(self):
+        """Rebuild the aggregates of one page of Users and queue the next"""
+        cursor = tasks.rebuild_rankings(self.request.get('cursor') or None)
+        if cursor:
+            taskqueue.add(url='/tasks/rebuild_rankings',
+                          params={'cursor': cursor})
+        else:
+            Migration.finish(Migration.RANKINGS)
+        self.response.set_status(204)
+
+
+class StartBackfillUserNames(InstrumentedHandler):
+    def get(self):
+        """Start claiming the names of the Users created before names were
+        claimed, then copying the Users' names onto the Games and Scores
+        written before they carried them, unless that is done. Called every
+        day using a cron job, starting at most one backfill a day"""
+        if not Migration.is_done(Migration.CLAIMED_NAMES):
+            kind = User._get_kind()
+        elif not Migration.is_done(Migration.USER_NAMES):
+            kind = Game._get_kind()
+        else:
+            return
+        try:
+            taskqueue.add(name='backfill-user-names-' +
+                          date.today().isoformat(),
+                          url='/tasks/backfill_user_names',
+                          params={'kind': kind})
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+
+class BackfillUserNames(InstrumentedHandler):
+    def post(self):
+        """Backfill one page of Users, Games or Scores and queue the next,
+        moving on to the Games once the Users' names are claimed and to the
+        Scores once the Games are done"""
+        kind = self.request.get('kind')
+        cursor = self.request.get('cursor') or None
+        if kind == User._get_kind():
+            cursor = tasks.claim_user_names(cursor)
+            if cursor:
+                taskqueue.add(url='/tasks/backfill_user_names',
+                              params={'kind': kind, 'cursor': cursor})
+            else:
+                Migration.finish(Migration.CLAIMED_NAMES)
+                if not Migration.is_done(Migration.USER_NAMES):
+                    taskqueue.add(url='/tasks/backfill_user_names',
+                                  params={'kind': Game._get_kind()})
+            self.response.set_status(204)
+            return
+        model = Score if kind == Score._get_kind() else Game
+        cursor = tasks.backfill_user_names(model, cursor)
+        if cursor:
+            taskqueue.add(url='/tasks/backfill_user_names',
+                          params={'kind': kind, 'cursor': cursor})
+        elif model is Game:
+            taskqueue.add(url='/tasks/backfill_user_names',
+                          params={'kind': Score._get_kind()})
+        else:
+            Migration.finish(Migration.USER_NAMES)
+        self.response.set_status(204)
+
+
+class StartArchiveGames(InstrumentedHandler):
+    def get(self):
+        """Start archiving the old finished Games, then the abandoned ones.
+        Until it has been done once, the Games written before they carried
+        an updated time are stamped with one first.
+        Called every day using a cron job"""
+        if Migration.is_done(Migration.GAME_UPDATED):
+            taskqueue.add(url='/tasks/archive_games')
+        else:
+            taskqueue.add(url='/tasks/archive_games', params={'stamp': 1})
+
+
+class ArchiveGames(InstrumentedHandler):
+    def post(self):
+        """Archive one page of Games and queue the next, moving on to the
+        abandoned Games once the finished ones are done. The cutoff of a
+        pass is passed on from page to page, so its cursor stays valid"""
+        cursor = self.request.get('cursor') or None
+        if self.request.get('stamp'):
+            cursor = tasks.stamp_games_updated(cursor)
+            if cursor:
+                taskqueue.add(url='/tasks/archive_games',
+                              params={'stamp': 1, 'cursor': cursor})
+            else:
+                Migration.finish(Migration.GAME_UPDATED)
+                taskqueue.add(url='/tasks/archive_games')
+            self.response.set_status(204)
+            return
+        abandoned = bool(self.request.get('abandoned'))
+        if self.request.get('cutoff'):
+            cutoff = datetime.strptime(self.request.get('cutoff'),
+                                       tasks.CUTOFF_FORMAT)
+        else:
+            cutoff = tasks.archive_cutoff(abandoned)
+        cursor = tasks.archive_games(abandoned, cutoff, cursor)
+        if cursor:
+            params = {'cursor': cursor,
+                      'cutoff': cutoff.strftime(tasks.CUTOFF_FORMAT)}
+            if abandoned:
+                params['abandoned'] = 1
+            taskqueue.add(url='/tasks/archive_games', params=params)
+        elif not abandoned:
+            taskqueue.add(url='/tasks/archive_games',
+                          params={'abandoned': 1})
         self.response.set_status(204)
 
 
+class ExportEntities(InstrumentedHandler):
+    def get(self):
+        """Export the Users, Games or Scores, picked by the kind parameter,
+        as newline delimited JSON. A response holds at most
+        transfer.EXPORT_LIMIT entities; when more remain the X-Next-Cursor
+        header is set, and passing it as the cursor parameter continues"""
+        model = transfer.MODELS.get(self.request.get('kind'))
+        if not model:
+            self.abort(400, 'kind must be one of {}'.format(
+                ', '.join(sorted(transfer.MODELS))))
+        self.response.content_type = 'application/x-ndjson'
+        try:
+            cursor = transfer.export(model, self.response.write,
+                                     self.request.get('cursor') or None)
+        except datastore_errors.BadValueError:
+            self.abort(400, 'Invalid Cursor')
+        if cursor:
+            self.response.headers['X-Next-Cursor'] = cursor
+
+
+class ImportEntities(InstrumentedHandler):
+    def post(self):
+        """Import Users, Games or Scores, picked by the kind parameter, from
+        a newline delimited JSON body as written by the export. Existing
+        entities with the same keys are overwritten"""
+        model = transfer.MODELS.get(self.request.get('kind'))
+        if not model:
+            self.abort(400, 'kind must be one of {}'.format(
+                ', '.join(sorted(transfer.MODELS))))
+        result = {'kind': model._get_kind()}
+        try:
+            result['imported'] = transfer.import_lines(model,
+                                                       self.request.body_file)
+        except transfer.ImportFailed, e:
+            logging.exception('Import of %s failed', result['kind'])
+            result.update(imported=e.imported, error=str(e))
+            self.response.set_status(
+                400 if isinstance(e.error, ValueError) else 500)
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(result))
+
+
+class Metrics(InstrumentedHandler):
+    def get(self):
+        """Show this instance's request, entity cache and task coalescing
+        counters as JSON"""
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps({
+            'requests': get_metrics(),
+            'entity_cache': cache.get_stats(),
+            'coalesced_tasks': {
+                tasks.AVERAGE_ATTEMPTS_TASK:
+                    get_coalesced_task_stats(tasks.AVERAGE_ATTEMPTS_TASK)},
+        }, indent=2, sort_keys=True))
+
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/crons/rebuild_rankings', StartRebuildUserRankings),
+    ('/crons/reconcile_active_games', ReconcileActiveGames),
+    ('/crons/backfill_user_names', StartBackfillUserNames),
+    ('/crons/rollup_leaderboards', RollupLeaderboards),
+    ('/crons/archive_games', StartArchiveGames),
     ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/tasks/rebuild_rankings', RebuildUserRankings),
+    ('/tasks/plan_reminders', PlanReminderShard),
+    ('/tasks/send_reminder', SendReminderShard),
+    ('/tasks/backfill_user_names', BackfillUserNames),
+    ('/tasks/archive_games', ArchiveGames),
+    ('/admin/metrics', Metrics),
+    ('/admin/export', ExportEntities),
+    ('/admin/import', ImportEntities),
 ], debug=True)
@@ -3,10 +3,16 @@ entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
 
-from datetime import date
+import base64
+import random
+from datetime import date, timedelta
 from protorpc import messages
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+from cache import CachedModel
+from engine import normalize_name, score_points, render_moves
+
 
 
 class User(ndb.Model):
@@ -14,7 +20,97 @@ class User(ndb.Model):
     name = ndb.StringProperty(required=True)
     email =ndb.StringProperty()
     performance = ndb.FloatProperty(required=True, default=0)
-    
+    games_played = ndb.IntegerProperty(required=True, default=0)
+    total_score = ndb.IntegerProperty(required=True, default=0)
+
+    @classmethod
+    def create(cls, name, email=None):
+        """Creates a User and claims its name. Returns None if the name is
+        already taken"""
+        if cls.get_by_name(name):
+            return None
+        return cls._create(name, email)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _create(cls, name, email):
+        name_key = ndb.Key(UserName, UserName.normalize(name))
+        if name_key.get():
+            return None
+        user = cls(name=name, email=email)
+        user.put()
+        UserName(key=name_key, user=user.key).put()
+        return user
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the User with the given name, or None. Uses strongly
+        consistent key gets, which ndb caches, rather than an index query"""
+        return cls.get_by_name_async(name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_name_async(cls, name):
+        user_key = yield cls.get_key_by_name_async(name)
+        user = None
+        if user_key:
+            user = yield user_key.get_async()
+        raise ndb.Return(user)
+
+    @classmethod
+    @ndb.tasklet
+    def get_key_by_name_async(cls, name):
+        """Returns a Future for the key of the User with the given name, or
+        None, without reading the User itself"""
+        user_name = yield ndb.Key(UserName, UserName.normalize(name)).get_async()
+        if user_name:
+            raise ndb.Return(user_name.user)
+        # Users created before their names were claimed get claimed here,
+        # until the user name backfill has claimed them all
+        if (yield Migration.is_done_async(Migration.CLAIMED_NAMES)):
+            raise ndb.Return(None)
+        user_key = yield cls.query(cls.name == name).get_async(keys_only=True)
+        if user_key:
+            yield UserName.get_or_insert_async(UserName.normalize(name),
+                                               user=user_key)
+        raise ndb.Return(user_key)
+
+    @classmethod
+    def record_score(cls, user_key, points):
+        """Adds the points of a finished game to the User's running
+        aggregates and updates the performance (mean score) used to rank"""
+        return cls.record_score_async(user_key, points).get_result()
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def record_score_async(cls, user_key, points):
+        user = yield user_key.get_async()
+        if not user:
+            raise ndb.Return(None)
+        user.games_played += 1
+        user.total_score += points
+        user.performance = float(user.total_score) / user.games_played
+        yield user.put_async()
+        raise ndb.Return(user)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def rebuild_score_async(cls, user_key, games_played, points):
+        """Sets the User's aggregates to those of points, the scores of all
+        its games, unless a game ended since the User was read with
+        games_played. Returns whether it did"""
+        user = yield user_key.get_async()
+        if not user or user.games_played != games_played:
+            raise ndb.Return(False)
+        user.games_played = len(points)
+        user.total_score = sum(points)
+        if points:
+            user.performance = float(user.total_score) / len(points)
+        else:
+            user.performance = 0.0
+        yield user.put_async()
+        raise ndb.Return(True)
+
     def to_form(self):
             """Returns a Form representation of the USER"""
             form = UserForm()
@@ -25,6 +121,16 @@ class User(ndb.Model):
             return form
 
 
+class UserName(ndb.Model):
+    """Claim on a User name, keyed by the normalized name so that names are
+    unique and a User is found by name with key gets"""
+    user = ndb.KeyProperty(required=True, kind='User')
+
+    @staticmethod
+    def normalize(name):
+        return normalize_name(name)
+
+
 class UserForm(messages.Message):
     """userForm for outbound user state information"""
     name = messages.StringField(1, required=True)
@@ -35,61 +141,202 @@ class UserForm(messages.Message):
 class UserForms(messages.Message):
     """userForms for outbound users' state information"""
     users = messages.MessageField(UserForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 class MovesForm(messages.Message):
-    """Form for outbound game history information"""
+    """Form for outbound game history information. Only the version is set
+    when not_modified is True"""
     moves = messages.StringField(1, repeated=True)
+    version = messages.IntegerField(2)
+    not_modified = messages.BooleanField(3, default=False)
 
 
-class Game(ndb.Model):
-    """Game object"""
+class Game(CachedModel):
+    """Game object, read through the entity cache"""
     target = ndb.StringProperty(required=True)
     current = ndb.StringProperty(required=True)
     attempts_allowed = ndb.IntegerProperty(required=True)
     attempts_remaining = ndb.IntegerProperty(required=True, default=5)
     game_over = ndb.BooleanProperty(required=True, default=False)
     user = ndb.KeyProperty(required=True, kind='User')
+    # Copy of the User's name so forms never read the User
+    user_name = ndb.StringProperty()
+    # Messages of the games created before the packed history
     moves = ndb.StringProperty(repeated=True)
+    # Packed (timestamp, hit, guess) records, see engine.pack_move
+    history = ndb.BlobProperty()
+    # Bumped by every put, so pollers can tell whether the game changed
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    # Time of the last write, for archiving finished and abandoned Games
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    # What to_active_form reads, for projection queries of active Games
+    ACTIVE_FORM_PROJECTION = ('attempts_remaining', 'current')
+    # Latest committed version of each Game, keyed by its urlsafe key
+    MEMCACHE_VERSION = 'GAME_VERSION:{}'
+
+    def _pre_put_hook(self):
+        self.version = (self.version or 0) + 1
+
+    def _post_put_hook(self, future):
+        super(Game, self)._post_put_hook(future)
+        key, version = self.key, self.version
+        ndb.get_context().call_on_commit(
+            lambda: memcache.set(Game.MEMCACHE_VERSION.format(key.urlsafe()),
+                                 version))
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        super(Game, cls)._post_delete_hook(key, future)
+        ndb.get_context().call_on_commit(
+            lambda: memcache.delete(cls.MEMCACHE_VERSION.format(
+                key.urlsafe())))
+
+    @classmethod
+    def is_unchanged(cls, urlsafe_key, version):
+        """Returns True if memcache says the Game is still at version.
+        Never reads the datastore, so a memcache miss returns False"""
+        if version is None:
+            return False
+        cached = memcache.get(cls.MEMCACHE_VERSION.format(urlsafe_key))
+        return cached == version
+
+    def remember_version(self):
+        """Caches the version of a Game that was read, unless a newer write
+        already did"""
+        memcache.add(Game.MEMCACHE_VERSION.format(self.key.urlsafe()),
+                     self.version)
 
     @classmethod
-    def new_game(cls, user, attempts, targetword, currentword, message):
+    def new_game(cls, user, attempts, targetword, currentword,
+                 user_name=None):
         """Creates and returns a new game"""
- 
-        game = Game(user=user,
-                    target=targetword,
-                    current=currentword,
-                    moves=message,
-                    attempts_allowed=attempts,
-                    attempts_remaining=attempts,
-                    game_over=False)
-        game.put()
-        return game
-
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+        return cls.new_game_async(user, attempts, targetword, currentword,
+                                  user_name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def new_game_async(cls, user, attempts, targetword, currentword,
+                       user_name=None):
+        games = yield cls.new_games_async(user, attempts,
+                                          [(targetword, currentword)],
+                                          user_name)
+        raise ndb.Return(games[0])
+
+    @classmethod
+    @ndb.tasklet
+    def new_games_async(cls, user, attempts, words, user_name=None):
+        """Creates one game per (targetword, currentword) pair in words with
+        a single batch put and a single ActiveGames update"""
+        games = [Game(user=user,
+                      user_name=user_name,
+                      target=targetword,
+                      current=currentword,
+                      attempts_allowed=attempts,
+                      attempts_remaining=attempts,
+                      game_over=False)
+                 for targetword, currentword in words]
+        yield ndb.put_multi_async(games)
+        ActiveGames.add(len(games), attempts * len(games))
+        raise ndb.Return(games)
+
+    def to_form(self, message, user_name=None):
+        """Returns a GameForm representation of the Game. The User is only
+        read when its name is not passed in"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = user_name or self.user_name or self.user.get().name
         form.attempts_remaining = self.attempts_remaining
         form.currentword = self.current
         form.game_over = self.game_over
         form.message = message
+        form.version = self.version
         return form
 
+    def to_active_form(self, message, user_name):
+        """Returns a GameForm representation of an active Game loaded by a
+        projection query on ACTIVE_FORM_PROJECTION"""
+        return GameForm(urlsafe_key=self.key.urlsafe(),
+                        user_name=user_name,
+                        attempts_remaining=self.attempts_remaining,
+                        currentword=self.current,
+                        game_over=False,
+                        message=message)
+
+    def render_moves(self, offset=0, limit=None):
+        """Returns the history of the game as messages, replaying the packed
+        guesses against the target to recover each result"""
+        creator_name = None
+        if not self.moves:
+            creator_name = self.user_name or self.user.get().name
+        return render_moves(self, creator_name, offset, limit)
+
     def end_game(self, won=False):
         """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+        the player lost. The Game, its Score and the User's aggregates are
+        written in one transaction, joining the caller's if there is one."""
+        return self.end_game_async(won).get_result()
+
+    @ndb.transactional_tasklet(xg=True)
+    def end_game_async(self, won=False):
         self.game_over = True
-        self.put()
+        ActiveGames.add(-1, -self.attempts_remaining)
         # Add the game to the score 'board'
-        if won:
-            points = len(self.target) + 14 - self.attempts_remaining
-        else:
-            points = 0
-        score = Score(user=self.user, date=date.today(), won=won,
+        points = score_points(self.target, self.attempts_remaining, won)
+        if not self.user_name:
+            user = yield self.user.get_async()
+            self.user_name = user.name
+        score = Score(user=self.user, user_name=self.user_name,
+                      date=date.today(), won=won,
                       score=points)
-                      
-        score.put()
+
+        # The writes and the read of the User's aggregates run concurrently
+        yield (ndb.put_multi_async([self, score]),
+               User.record_score_async(self.user, points))
+        Leaderboard.add_score(score)
+
+    @classmethod
+    @ndb.transactional
+    def backfill(cls, game_key, user_name):
+        """Sets the copy of the User's name on a Game that has none"""
+        game = game_key.get()
+        if game and not game.user_name:
+            game.user_name = user_name
+            game.put()
+
+    @classmethod
+    @ndb.transactional
+    def stamp_updated(cls, game_key):
+        """Gives a Game written before it carried an updated time one, the
+        time of this write, so that it is eventually archived"""
+        game = game_key.get()
+        if game and not game.updated:
+            game.put()
+
+    @classmethod
+    @ndb.transactional
+    def delete_if_abandoned(cls, game_key, cutoff):
+        """Deletes an unfinished Game that was not written since cutoff, and
+        removes it from the ActiveGames counter. Returns whether it did, so
+        a Game played since it was queried is kept"""
+        game = game_key.get()
+        if not game or game.game_over or game.updated >= cutoff:
+            return False
+        game_key.delete()
+        ActiveGames.add(-1, -game.attempts_remaining)
+        return True
+
+    def to_archive_record(self):
+        """Returns the Game as a dict that can be stored as JSON"""
+        return {'id': self.key.id(),
+                'target': self.target,
+                'current': self.current,
+                'attempts_allowed': self.attempts_allowed,
+                'attempts_remaining': self.attempts_remaining,
+                'game_over': self.game_over,
+                'updated': self.updated.isoformat(),
+                'moves': list(self.moves),
+                'history': base64.b64encode(self.history or '')}
 
 
 
@@ -98,23 +345,288 @@ class Game(ndb.Model):
 class Score(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
+    # Copy of the User's name so forms never read the User
+    user_name = ndb.StringProperty()
     date = ndb.DateProperty(required=True)
     won = ndb.BooleanProperty(required=True)
     score = ndb.IntegerProperty(required=True)
 
-    def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
-                         date=str(self.date), score=self.score)
+    # What to_form reads, for projection queries. Scores are only returned
+    # once they carry user_name, see the user name backfill in main.py
+    FORM_PROJECTION = ('user_name', 'date', 'won', 'score')
+    # The same when the User's name is passed to to_form
+    USER_FORM_PROJECTION = ('date', 'won', 'score')
+    # The same when the date is filtered on
+    DAY_FORM_PROJECTION = ('user_name', 'won', 'score')
+
+    def to_form(self, user_name=None):
+        return ScoreForm(user_name=(user_name or self.user_name or
+                                    self.user.get().name),
+                         won=self.won, date=str(self.date), score=self.score)
+
+    @classmethod
+    def to_forms(cls, scores, user_names=None):
+        """Returns ScoreForm representations of many Scores, resolving all of
+        their Users' names with a single batch get. Scores that carry the
+        name are never asked for their user, which projections leave out"""
+        user_names = resolve_user_names(scores, user_names)
+        return [score.to_form(score.user_name or user_names.get(score.user))
+                for score in scores]
+
+
+class ActiveGames(ndb.Model):
+    """One shard of the running count of active Games and of the sum of
+    their attempts remaining. Spreading the counter over NUM_SHARDS entities
+    keeps every game creation and move from contending on one entity"""
+    games = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    attempts_remaining = ndb.IntegerProperty(required=True, default=0,
+                                             indexed=False)
+
+    NUM_SHARDS = 20
+    MEMCACHE_GAMES = 'ACTIVE_GAMES'
+    MEMCACHE_ATTEMPTS_REMAINING = 'ACTIVE_GAMES_ATTEMPTS_REMAINING'
+
+    @classmethod
+    def shard_keys(cls):
+        return [ndb.Key(cls, str(i)) for i in range(cls.NUM_SHARDS)]
+
+    @classmethod
+    def add(cls, games, attempts_remaining):
+        """Adds the deltas to the counter. Inside a transaction the update is
+        deferred until the transaction commits, so retries never count
+        twice"""
+        ndb.get_context().call_on_commit(
+            lambda: cls._add(games, attempts_remaining))
+
+    @classmethod
+    def _add(cls, games, attempts_remaining):
+        cls._add_to_shard(random.randint(0, cls.NUM_SHARDS - 1),
+                          games, attempts_remaining)
+        # Only offsets cached totals, a missing copy is rebuilt on read
+        memcache.offset_multi({cls.MEMCACHE_GAMES: games,
+                               cls.MEMCACHE_ATTEMPTS_REMAINING:
+                                   attempts_remaining})
+
+    @classmethod
+    # Runs from the commit callback of the caller's transaction, which is
+    # still current but finished, so it must not be joined
+    @ndb.transactional(propagation=ndb.TransactionOptions.INDEPENDENT)
+    def _add_to_shard(cls, index, games, attempts_remaining):
+        shard = cls.get_by_id(str(index)) or cls(id=str(index))
+        shard.games += games
+        shard.attempts_remaining += attempts_remaining
+        shard.put()
+
+    @classmethod
+    def totals(cls):
+        """Returns the number of active Games and their total attempts
+        remaining, from memcache or else by summing the shards"""
+        cached = memcache.get_multi([cls.MEMCACHE_GAMES,
+                                     cls.MEMCACHE_ATTEMPTS_REMAINING])
+        if len(cached) == 2:
+            return (cached[cls.MEMCACHE_GAMES],
+                    cached[cls.MEMCACHE_ATTEMPTS_REMAINING])
+        shards = [shard for shard in ndb.get_multi(cls.shard_keys()) if shard]
+        games = sum(shard.games for shard in shards)
+        attempts_remaining = sum(shard.attempts_remaining for shard in shards)
+        memcache.add_multi({cls.MEMCACHE_GAMES: games,
+                            cls.MEMCACHE_ATTEMPTS_REMAINING:
+                                attempts_remaining})
+        return games, attempts_remaining
+
+    @classmethod
+    def reset(cls, games, attempts_remaining):
+        """Overwrites the counter with totals recounted from the Games, to
+        correct any drift"""
+        shards = [cls(key=key) for key in cls.shard_keys()]
+        shards[0].games = games
+        shards[0].attempts_remaining = attempts_remaining
+        ndb.put_multi(shards)
+        memcache.delete_multi([cls.MEMCACHE_GAMES,
+                               cls.MEMCACHE_ATTEMPTS_REMAINING])
+
+
+class Leaderboard(ndb.Model):
+    """Materialized top SIZE scores of a day, a week or all time, kept in
+    score order so it is served without querying the Scores"""
+    entries = ndb.JsonProperty(default=[])
+
+    SIZE = 20
+    DAILY = 'daily'
+    WEEKLY = 'weekly'
+    ALL_TIME = 'alltime'
+    MEMCACHE_PREFIX = 'LEADERBOARD:'
+
+    @classmethod
+    def board_ids(cls, day):
+        """Maps each period to the id of its board containing day"""
+        monday = day - timedelta(days=day.weekday())
+        return {cls.DAILY: 'daily-' + day.isoformat(),
+                cls.WEEKLY: 'weekly-' + monday.isoformat(),
+                cls.ALL_TIME: cls.ALL_TIME}
+
+    @staticmethod
+    def entry(score, day=None):
+        """Returns the board entry of a Score, which may be projected
+        without its date if the date is passed in"""
+        return {'user_name': score.user_name,
+                'date': (day or score.date).isoformat(),
+                'won': score.won,
+                'score': score.score}
+
+    @classmethod
+    def get_entries(cls, board_id):
+        """Returns the entries of a board from memcache or its entity"""
+        entries = memcache.get(cls.MEMCACHE_PREFIX + board_id)
+        if entries is None:
+            board = cls.get_by_id(board_id)
+            entries = board.entries if board else []
+            memcache.add(cls.MEMCACHE_PREFIX + board_id, entries)
+        return entries
+
+    @classmethod
+    def to_forms(cls, board_id):
+        return [ScoreForm(user_name=entry['user_name'], date=entry['date'],
+                          won=entry['won'], score=entry['score'])
+                for entry in cls.get_entries(board_id)]
+
+    @classmethod
+    def add_score(cls, score):
+        """Merges a new Score into the boards it makes, once the current
+        transaction, if any, commits"""
+        ndb.get_context().call_on_commit(lambda: cls._add_score(score))
+
+    @classmethod
+    def _add_score(cls, score):
+        entry = cls.entry(score)
+        merges = []
+        for board_id in cls.board_ids(score.date).itervalues():
+            entries = cls.get_entries(board_id)
+            # Most scores do not make a full board and cost no write
+            if (len(entries) >= cls.SIZE and
+                    entry['score'] <= entries[-1]['score']):
+                continue
+            merges.append(cls._merge_async(board_id, [entry]))
+        for merge in merges:
+            merge.get_result()
+
+    @classmethod
+    # Runs from the commit callback of the Score's transaction, which is
+    # still current but finished, so it must not be joined
+    @ndb.transactional_tasklet(
+        propagation=ndb.TransactionOptions.INDEPENDENT)
+    def _merge_async(cls, board_id, new_entries):
+        board = yield cls.get_by_id_async(board_id)
+        board = board or cls(id=board_id)
+        cls._set_entries(board, board.entries + new_entries)
+        yield board.put_async()
+        cls._cache(board)
+
+    @classmethod
+    def replace(cls, board_id, entries):
+        """Overwrites a board with entries rolled up from the Scores"""
+        board = cls(id=board_id)
+        cls._set_entries(board, entries)
+        board.put()
+        cls._cache(board)
+
+    @classmethod
+    def _set_entries(cls, board, entries):
+        board.entries = sorted(entries, key=lambda entry: -entry['score'])
+        board.entries = board.entries[:cls.SIZE]
+
+    @classmethod
+    def _cache(cls, board):
+        """Copies a board to memcache once its transaction, if any, commits"""
+        memcache_key = cls.MEMCACHE_PREFIX + board.key.id()
+        ndb.get_context().call_on_commit(
+            lambda: memcache.set(memcache_key, board.entries))
+
+
+class GameArchive(ndb.Model):
+    """Compacted copies of a User's archived Games, child of the User. Each
+    archiving batch writes one per User, keyed by the id of its first Game so
+    a retried batch overwrites it. A Game in several archives was archived
+    again after being played, and its latest 'updated' is its final state"""
+    games = ndb.JsonProperty(compressed=True)
+    count = ndb.IntegerProperty(required=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def archive(cls, games):
+        """Writes the games into one GameArchive per User"""
+        by_user = {}
+        for game in games:
+            by_user.setdefault(game.user, []).append(game)
+        ndb.put_multi([GameArchive(parent=user_key,
+                                   id=user_games[0].key.id(),
+                                   games=[game.to_archive_record()
+                                          for game in user_games],
+                                   count=len(user_games))
+                       for user_key, user_games in by_user.iteritems()])
+
+
+class Migration(ndb.Model):
+    """Marks a one-off data migration as finished, keyed by its name"""
+    USER_NAMES = 'user-names'
+    CLAIMED_NAMES = 'claimed-names'
+    RANKINGS = 'rankings'
+    GAME_UPDATED = 'game-updated'
+
+    @classmethod
+    def is_done(cls, name):
+        """Read through ndb's caches, so it costs no datastore read"""
+        return cls.is_done_async(name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def is_done_async(cls, name):
+        migration = yield cls.get_by_id_async(name)
+        raise ndb.Return(migration is not None)
+
+    @classmethod
+    def finish(cls, name):
+        cls(id=name).put()
+
+
+class ReminderRun(ndb.Model):
+    """Progress of one day's reminder emails: the cursor over the Users with
+    active Games and how many shards of them have been queued so far"""
+    cursor = ndb.StringProperty(indexed=False)
+    shards = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    done = ndb.BooleanProperty(required=True, default=False, indexed=False)
+
+
+class ReminderShard(ndb.Model):
+    """Progress of one shard of reminder emails: how many of its Users have
+    been processed, so a retried task does not email them again"""
+    processed = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+
+def resolve_user_names(entities, user_names=None):
+    """Maps the User keys referenced by entities to the Users' names. Names
+    already known are passed in as user_names or copied on the entities, the
+    rest are fetched with one ndb.get_multi instead of one get per entity"""
+    user_names = dict(user_names or {})
+    keys = list(set(entity.user for entity in entities
+                    if not entity.user_name) - set(user_names))
+    for key, user in zip(keys, ndb.get_multi(keys)):
+        if user:
+            user_names[key] = user.name
+    return user_names
 
 
 class GameForm(messages.Message):
-    """GameForm for outbound game state information"""
+    """GameForm for outbound game state information. Only the key, the
+    version and the message are set when not_modified is True"""
     urlsafe_key = messages.StringField(1, required=True)
-    attempts_remaining = messages.IntegerField(2, required=True)
-    currentword = messages.StringField(3, required=True)
-    game_over = messages.BooleanField(4, required=True)
+    attempts_remaining = messages.IntegerField(2)
+    currentword = messages.StringField(3)
+    game_over = messages.BooleanField(4)
     message = messages.StringField(5, required=True)
-    user_name = messages.StringField(6, required=True)
+    user_name = messages.StringField(6)
+    version = messages.IntegerField(7)
+    not_modified = messages.BooleanField(8, default=False)
 
 class GameForms(messages.Message):
     """GameForms for outbound games' state information"""
@@ -128,11 +640,36 @@ class NewGameForm(messages.Message):
     attempts = messages.IntegerField(2, default=5)
 
 
+class NewGamesForm(messages.Message):
+    """Used to create several new games for one User"""
+    user_name = messages.StringField(1, required=True)
+    attempts = messages.IntegerField(2, default=5)
+    count = messages.IntegerField(3, default=1)
+
+
 class MakeMoveForm(messages.Message):
     """Used to make a move in an existing game"""
     guess = messages.StringField(1, required=True)
 
 
+class MakeMovesForm(messages.Message):
+    """Used to make several moves in an existing game"""
+    guesses = messages.StringField(1, repeated=True)
+
+
+class MoveResultForm(messages.Message):
+    """MoveResultForm for the outcome of one of several moves"""
+    guess = messages.StringField(1, required=True)
+    message = messages.StringField(2, required=True)
+    currentword = messages.StringField(3, required=True)
+
+
+class MovesResultForm(messages.Message):
+    """Return the outcome of each move and the final game state"""
+    results = messages.MessageField(MoveResultForm, 1, repeated=True)
+    game = messages.MessageField(GameForm, 2, required=True)
+
+
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
     user_name = messages.StringField(1, required=True)
@@ -144,6 +681,7 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class StringMessage(messages.Message):
@@ -0,0 +1,83 @@
+"""ndb_repository.py - The datastore implementation of the game engine's
+repository (see repository.py), built on the models and used in production."""
+
+from google.appengine.ext import ndb
+
+from models import User, Game, Score, ActiveGames, Migration
+from repository import Repository
+from utils import get_key_by_urlsafe, get_multi_by_urlsafe, fetch_page
+
+
+class NdbRepository(Repository):
+    """Users, Games and Scores are the ndb entities, Games are read through
+    the entity cache and fetched by their urlsafe keys"""
+
+    def create_user(self, name, email=None):
+        return User.create(name, email)
+
+    def get_user(self, name):
+        return User.get_by_name(name)
+
+    def new_games(self, user, attempts, words):
+        return Game.new_games_async(user.key, attempts, words,
+                                    user.name).get_result()
+
+    def game_id(self, game):
+        return game.key.urlsafe()
+
+    def get_games(self, game_ids):
+        return get_multi_by_urlsafe(game_ids, Game)
+
+    def get_game_for_update(self, game_id):
+        # Not through the entity cache, so the transaction reads the
+        # committed Game
+        return get_key_by_urlsafe(game_id, Game).get()
+
+    def transaction(self, function, *args):
+        return ndb.transaction(lambda: function(*args), xg=True)
+
+    def save_game(self, game):
+        game.put()
+
+    def end_game(self, game, won):
+        game.end_game(won)
+
+    def delete_game(self, game):
+        game.key.delete()
+        ActiveGames.add(-1, -game.attempts_remaining)
+
+    def update_active_games(self, games, attempts_remaining):
+        ActiveGames.add(games, attempts_remaining)
+
+    def active_totals(self):
+        return ActiveGames.totals()
+
+    def user_games(self, user):
+        return Game.query(Game.user == user.key,
+                          Game.game_over == False).fetch(
+                              projection=Game.ACTIVE_FORM_PROJECTION)
+
+    def user_scores(self, user):
+        return Score.query(Score.user == user.key).fetch(
+            projection=Score.USER_FORM_PROJECTION)
+
+    def scores(self, page_size=None, cursor=None):
+        return fetch_page(Score.query(), page_size, cursor,
+                          **self._score_form_options())
+
+    def high_scores(self, page_size=None, cursor=None):
+        return fetch_page(Score.query().order(-Score.score), page_size,
+                          cursor, **self._score_form_options())
+
+    @staticmethod
+    def _score_form_options():
+        """Scores are listed with a projection on their copy of the User's
+        name, which would leave out the Scores written before it until the
+        user name backfill has run"""
+        if Migration.is_done(Migration.USER_NAMES):
+            return {'projection': Score.FORM_PROJECTION}
+        return {}
+
+    def rankings(self, page_size=None, cursor=None):
+        return fetch_page(User.query().order(-User.performance), page_size,
+                          cursor)
@@ -0,0 +1,264 @@
+"""repository.py - The storage the game engine (engine.py) plays against, and
+an in-memory implementation of it with the datastore's semantics: names are
+unique ignoring case, reads return copies, pages are ordered like the
+datastore queries and transactions are serializable. ndb_repository.py holds
+the datastore implementation used in production."""
+
+import copy
+import itertools
+import threading
+from datetime import date, datetime
+
+from engine import BadRequestError, normalize_name, score_points
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def clamp_page_size(page_size):
+    """Falls back to DEFAULT_PAGE_SIZE and caps at MAX_PAGE_SIZE, so a
+    single request never materializes an unbounded result set"""
+    if not page_size or page_size < 1:
+        page_size = DEFAULT_PAGE_SIZE
+    return min(page_size, MAX_PAGE_SIZE)
+
+
+class Repository(object):
+    """What the game engine needs from storage. Users, Games and Scores are
+    returned as objects with the attributes of the models in models.py, and
+    the cursors are opaque strings"""
+
+    def create_user(self, name, email=None):
+        """Creates a User and claims its name. Returns None if the name is
+        already taken"""
+        raise NotImplementedError
+
+    def get_user(self, name):
+        """Returns the User with the given name, or None"""
+        raise NotImplementedError
+
+    def new_games(self, user, attempts, words):
+        """Creates one active Game per (target, current) pair in words with
+        a single write. Returns the Games"""
+        raise NotImplementedError
+
+    def game_id(self, game):
+        """Returns the string the Game is fetched by"""
+        raise NotImplementedError
+
+    def get_games(self, game_ids):
+        """Returns the Games, with None for the ids of no Game"""
+        raise NotImplementedError
+
+    def get_game_for_update(self, game_id):
+        """Returns the Game, or None, read within the current transaction"""
+        raise NotImplementedError
+
+    def transaction(self, function, *args):
+        """Runs function(*args) in a transaction and returns its result"""
+        raise NotImplementedError
+
+    def save_game(self, game):
+        raise NotImplementedError
+
+    def end_game(self, game, won):
+        """Ends the Game and writes it, its Score and the User's aggregates
+        together, and removes it from the active games"""
+        raise NotImplementedError
+
+    def delete_game(self, game):
+        """Deletes an active Game and removes it from the active games"""
+        raise NotImplementedError
+
+    def update_active_games(self, games, attempts_remaining):
+        """Adds to the count of active Games and to the sum of their
+        attempts remaining"""
+        raise NotImplementedError
+
+    def active_totals(self):
+        """Returns the count of active Games and the sum of their attempts
+        remaining"""
+        raise NotImplementedError
+
+    def user_games(self, user):
+        """Returns the User's active Games. Only their attempts remaining
+        and current word need to be loaded"""
+        raise NotImplementedError
+
+    def user_scores(self, user):
+        """Returns the User's Scores. Their user_name need not be loaded"""
+        raise NotImplementedError
+
+    def scores(self, page_size=None, cursor=None):
+        """Returns a page of Scores and the cursor of the next page, or
+        None. Only what a ScoreForm shows needs to be loaded"""
+        raise NotImplementedError
+
+    def high_scores(self, page_size=None, cursor=None):
+        """Like scores, from the highest score"""
+        raise NotImplementedError
+
+    def rankings(self, page_size=None, cursor=None):
+        """Returns a page of Users from the highest performance and the
+        cursor of the next page, or None"""
+        raise NotImplementedError
+
+
+class Record(object):
+    """A stored User, Game or Score"""
+
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+    def copy(self):
+        record = copy.copy(self)
+        if 'moves' in self.__dict__:
+            record.moves = list(self.moves)
+        return record
+
+
+class MemoryRepository(Repository):
+    """Keeps everything in dicts of one process. A single re-entrant lock
+    serializes the transactions with every other read and write"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._users = {}
+        self._user_names = {}
+        self._games = {}
+        self._scores = {}
+        self._active = [0, 0]
+
+    def create_user(self, name, email=None):
+        with self._lock:
+            if normalize_name(name) in self._user_names:
+                return None
+            user = Record(id=next(self._ids), name=name, email=email,
+                          performance=0.0, games_played=0, total_score=0)
+            self._users[user.id] = user
+            self._user_names[normalize_name(name)] = user.id
+            return user.copy()
+
+    def get_user(self, name):
+        with self._lock:
+            user_id = self._user_names.get(normalize_name(name))
+            return self._users[user_id].copy() if user_id else None
+
+    def new_games(self, user, attempts, words):
+        with self._lock:
+            games = [Record(id=next(self._ids), user=user.id,
+                            user_name=user.name, target=target,
+                            current=current, attempts_allowed=attempts,
+                            attempts_remaining=attempts, game_over=False,
+                            moves=[], history='', version=0, updated=None)
+                     for target, current in words]
+            for game in games:
+                self.save_game(game)
+            self.update_active_games(len(games), attempts * len(games))
+            return games
+
+    def game_id(self, game):
+        return str(game.id)
+
+    def get_games(self, game_ids):
+        with self._lock:
+            games = [self._games.get(self._parse_id(game_id))
+                     for game_id in game_ids]
+            return [game.copy() if game else None for game in games]
+
+    def get_game_for_update(self, game_id):
+        return self.get_games([game_id])[0]
+
+    def transaction(self, function, *args):
+        # Nothing is written until the function saves it, so an exception
+        # leaves the stored records as they were
+        with self._lock:
+            return function(*args)
+
+    def save_game(self, game):
+        with self._lock:
+            game.version += 1
+            game.updated = datetime.now()
+            self._games[game.id] = game.copy()
+
+    def end_game(self, game, won):
+        with self._lock:
+            game.game_over = True
+            self.update_active_games(-1, -game.attempts_remaining)
+            points = score_points(game.target, game.attempts_remaining, won)
+            score = Record(id=next(self._ids), user=game.user,
+                           user_name=game.user_name, date=date.today(),
+                           won=won, score=points)
+            self._scores[score.id] = score
+            user = self._users.get(game.user)
+            if user:
+                user.games_played += 1
+                user.total_score += points
+                user.performance = (float(user.total_score) /
+                                    user.games_played)
+            self.save_game(game)
+
+    def delete_game(self, game):
+        with self._lock:
+            if self._games.pop(game.id, None):
+                self.update_active_games(-1, -game.attempts_remaining)
+
+    def update_active_games(self, games, attempts_remaining):
+        with self._lock:
+            self._active[0] += games
+            self._active[1] += attempts_remaining
+
+    def active_totals(self):
+        with self._lock:
+            return tuple(self._active)
+
+    def user_games(self, user):
+        with self._lock:
+            return [game.copy() for game_id, game
+                    in sorted(self._games.iteritems())
+                    if game.user == user.id and not game.game_over]
+
+    def user_scores(self, user):
+        with self._lock:
+            return [score.copy() for score_id, score
+                    in sorted(self._scores.iteritems())
+                    if score.user == user.id]
+
+    def scores(self, page_size=None, cursor=None):
+        with self._lock:
+            scores = [score for score_id, score
+                      in sorted(self._scores.iteritems())]
+            return self._page(scores, page_size, cursor)
+
+    def high_scores(self, page_size=None, cursor=None):
+        with self._lock:
+            scores = sorted(self._scores.itervalues(),
+                            key=lambda score: (-score.score, score.id))
+            return self._page(scores, page_size, cursor)
+
+    def rankings(self, page_size=None, cursor=None):
+        with self._lock:
+            users = sorted(self._users.itervalues(),
+                           key=lambda user: (-user.performance, user.id))
+            return self._page(users, page_size, cursor)
+
+    @staticmethod
+    def _parse_id(game_id):
+        try:
+            return int(game_id)
+        except (TypeError, ValueError):
+            raise BadRequestError('Invalid Key')
+
+    @staticmethod
+    def _page(records, page_size, cursor):
+        """Returns a page of copies of records and the cursor of the next
+        page. The cursor is the offset, which unlike a datastore cursor
+        shifts if records are added before it"""
+        try:
+            offset = int(cursor) if cursor else 0
+        except ValueError:
+            raise BadRequestError('Invalid Cursor')
+        end = offset + clamp_page_size(page_size)
+        page = [record.copy() for record in records[offset:end]]
+        return page, str(end) if end < len(records) else None
@@ -0,0 +1,198 @@
+"""tasks.py - The background work run by the task queue and cron handlers in
+main.py. Only depends on the models and ndb, so the handlers' instances never
+load the endpoints stack."""
+
+import logging
+import os
+from datetime import date, datetime, timedelta
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import User, UserName, Game, Score, ActiveGames, Leaderboard,\
+    GameArchive, Migration, resolve_user_names
+from utils import fetch_page
+
+MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+AVERAGE_ATTEMPTS_TASK = 'cache-average-attempts'
+AVERAGE_ATTEMPTS_MESSAGE = 'The average moves remaining is {:.2f}'
+# At most one average recompute is pending per interval (seconds)
+AVERAGE_ATTEMPTS_DEBOUNCE = int(os.environ.get('AVERAGE_ATTEMPTS_DEBOUNCE',
+                                               10))
+REBUILD_RANKINGS_BATCH_SIZE = 100
+BACKFILL_BATCH_SIZE = 100
+ARCHIVE_BATCH_SIZE = 100
+# Days after which finished Games are archived, and unfinished Games that
+# were not played are archived as abandoned
+GAME_RETENTION_DAYS = int(os.environ.get('GAME_RETENTION_DAYS', 30))
+ABANDONED_GAME_DAYS = int(os.environ.get('ABANDONED_GAME_DAYS', 90))
+# How an archive pass passes its cutoff on to the task of its next page
+CUTOFF_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def average_attempts_message():
+    """Returns the message of the average moves remaining of the active
+    Games, read from the ActiveGames counter, or '' if there are none"""
+    count, total_attempts_remaining = ActiveGames.totals()
+    if count > 0:
+        average = float(total_attempts_remaining)/count
+        return AVERAGE_ATTEMPTS_MESSAGE.format(average)
+    return ''
+
+
+def cache_average_attempts():
+    """Populates memcache with the average moves remaining message. Returns
+    the cached message"""
+    message = average_attempts_message()
+    memcache.set(MEMCACHE_MOVES_REMAINING, message)
+    return message
+
+
+def reconcile_active_games():
+    """Recounts the active Games and their attempts remaining, resets the
+    ActiveGames counter to the result and refreshes the cached average"""
+    count = 0
+    total_attempts_remaining = 0
+    for game in Game.query(Game.game_over == False).iter(
+            projection=[Game.attempts_remaining]):
+        count += 1
+        total_attempts_remaining += game.attempts_remaining
+    ActiveGames.reset(count, total_attempts_remaining)
+    memcache.delete(MEMCACHE_MOVES_REMAINING)
+    cache_average_attempts()
+
+
+def rebuild_rankings(cursor=None):
+    """Recomputes the score aggregates of a page of Users from their
+    Scores. Each User is written in its own transaction, and skipped if a
+    game of theirs ended after the page was read, so no Score recorded
+    meanwhile is lost; the next rebuild covers them. Once the first
+    rebuild has set the aggregates of the Users that predate them, Users
+    whose Scores do not add up to their games played are skipped too: the
+    Score query is eventually consistent and may miss a game that just
+    ended. Returns the cursor of the next page or None when finished"""
+    counted = Migration.is_done(Migration.RANKINGS)
+    users, next_cursor = fetch_page(User.query(),
+                                    REBUILD_RANKINGS_BATCH_SIZE, cursor)
+    futures = [Score.query(Score.user == user.key).fetch_async(
+                   projection=[Score.score]) for user in users]
+    updates = []
+    for user, future in zip(users, futures):
+        points = [score.score for score in future.get_result()]
+        if counted and len(points) != user.games_played:
+            logging.warning('Not rebuilding %s: %d Scores for %d games',
+                            user.name, len(points), user.games_played)
+            continue
+        updates.append(User.rebuild_score_async(user.key, user.games_played,
+                                                points))
+    for update in updates:
+        update.get_result()
+    return next_cursor
+
+
+def rollup_leaderboards():
+    """Rebuilds today's, this week's and the all-time Leaderboards from
+    the Scores, correcting anything the incremental merges missed"""
+    today = date.today()
+    monday = today - timedelta(days=today.weekday())
+    days = [monday + timedelta(days=i) for i in range(today.weekday() + 1)]
+    # Each day is ranked with an equality filter, which the projection
+    # cannot return, so the day is filled back in
+    futures = [(day, Score.query(Score.date == day).order(-Score.score)
+                .fetch_async(Leaderboard.SIZE,
+                             projection=Score.DAY_FORM_PROJECTION))
+               for day in days]
+    all_time = Score.query().order(-Score.score).fetch_async(
+        Leaderboard.SIZE, projection=Score.FORM_PROJECTION)
+    entries = dict((day, [Leaderboard.entry(score, day)
+                          for score in future.get_result()])
+                   for day, future in futures)
+
+    board_ids = Leaderboard.board_ids(today)
+    Leaderboard.replace(board_ids[Leaderboard.DAILY], entries[today])
+    Leaderboard.replace(board_ids[Leaderboard.WEEKLY],
+                        sum(entries.values(), []))
+    Leaderboard.replace(board_ids[Leaderboard.ALL_TIME],
+                        [Leaderboard.entry(score)
+                         for score in all_time.get_result()])
+
+
+def claim_user_names(cursor=None):
+    """Claims the names of a page of Users created before their names were
+    claimed with a UserName. Returns the cursor of the next page or None
+    when finished"""
+    users, next_cursor = fetch_page(User.query(), BACKFILL_BATCH_SIZE,
+                                    cursor, projection=[User.name])
+    claims = [UserName.get_or_insert_async(UserName.normalize(user.name),
+                                           user=user.key)
+              for user in users]
+    for claim in claims:
+        claim.get_result()
+    return next_cursor
+
+
+def backfill_user_names(model, cursor=None):
+    """Copies the User's name onto a page of Games or Scores written
+    before they carried it. Returns the cursor of the next page or None
+    when finished"""
+    entities, next_cursor = fetch_page(model.query(), BACKFILL_BATCH_SIZE,
+                                       cursor)
+    if model is Game:
+        games = [game for game in entities if not game.user_name]
+        user_names = resolve_user_names(games)
+        # Games may be played meanwhile, so each is updated in its own
+        # transaction rather than overwritten
+        for game in games:
+            if game.user in user_names:
+                Game.backfill(game.key, user_names[game.user])
+        return next_cursor
+    entities = [entity for entity in entities if not entity.user_name]
+    user_names = resolve_user_names(entities)
+    # Entities whose User no longer exists are left alone
+    entities = [entity for entity in entities
+                if entity.user in user_names]
+    for entity in entities:
+        entity.user_name = user_names[entity.user]
+    ndb.put_multi(entities)
+    return next_cursor
+
+
+def stamp_games_updated(cursor=None):
+    """Gives the Games of a page that were written before they carried an
+    updated time one, since the archive's query on updated cannot find
+    them. Returns the cursor of the next page or None when finished"""
+    games, next_cursor = fetch_page(Game.query(), ARCHIVE_BATCH_SIZE, cursor)
+    # Games may be played meanwhile, so each is stamped in its own
+    # transaction rather than overwritten
+    for game in games:
+        if not game.updated:
+            Game.stamp_updated(game.key)
+    return next_cursor
+
+
+def archive_cutoff(abandoned=False):
+    """Returns the time before which Games finished, or abandoned
+    unfinished Games were last played, to be archived"""
+    if abandoned:
+        return datetime.now() - timedelta(days=ABANDONED_GAME_DAYS)
+    return datetime.now() - timedelta(days=GAME_RETENTION_DAYS)
+
+
+def archive_games(abandoned, cutoff, cursor=None):
+    """Copies a page of the Games finished, or abandoned unfinished, before
+    cutoff into their Users' GameArchives and deletes them. Every page of a
+    pass must use the same cutoff, or the cursor would be reused with
+    another query. Returns the cursor of the next page or None when
+    finished"""
+    query = Game.query(Game.game_over == (not abandoned),
+                       Game.updated < cutoff)
+    games, next_cursor = fetch_page(query, ARCHIVE_BATCH_SIZE, cursor)
+    GameArchive.archive(games)
+    if abandoned:
+        # A move may be made meanwhile, so each Game is checked and removed
+        # from the active counter in its own transaction
+        for game in games:
+            Game.delete_if_abandoned(game.key, cutoff)
+    else:
+        # Finished Games are never written again
+        ndb.delete_multi([game.key for game in games])
+    return next_cursor
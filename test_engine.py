@@ -0,0 +1,125 @@
+"""test_engine.py - Tests of the game engine (engine.py) on the in-memory
+repository. Nothing here needs App Engine, so they run on any Python 2.7:
+
+    python -m unittest test_engine
+"""
+
+import unittest
+
+from engine import GameEngine, BadRequestError, NotFoundError, \
+    pack_move, unpack_moves, render_moves, apply_move, score_points
+from repository import MemoryRepository, Record
+
+
+class MovesTest(unittest.TestCase):
+    """The packed move history and the messages replayed from it"""
+
+    def new_game(self, target):
+        return Record(target=target, current='*' * len(target),
+                      attempts_remaining=5, moves=[], history='')
+
+    def test_pack_unpack(self):
+        history = (pack_move(u'w', True, 1) + pack_move(u'\xe9', False, 2) +
+                   pack_move(u'word', True, 3))
+        self.assertEqual(list(unpack_moves(history)),
+                         [(1, True, u'w'), (2, False, u'\xe9'),
+                          (3, True, u'word')])
+
+    def test_render_moves(self):
+        game = self.new_game('word')
+        apply_move(game, u'o')
+        apply_move(game, u'x')
+        apply_move(game, u'word')
+        self.assertEqual(render_moves(game, 'alice'), [
+            'alice created a new game',
+            "made a guess: 'o', result: *o**, Bingo!",
+            "made a guess: 'x', result: *o**, You missed!!",
+            "made a guess: 'word', result: word, You win!"])
+        self.assertEqual(render_moves(game, 'alice', 1, 1),
+                         ["made a guess: 'o', result: *o**, Bingo!"])
+
+    def test_render_non_ascii_moves(self):
+        game = self.new_game('word')
+        apply_move(game, u'\xe9')
+        self.assertEqual(render_moves(game, u'\xe9mile'), [
+            u'\xe9mile created a new game',
+            u"made a guess: '\xe9', result: ****, You missed!!"])
+
+
+class GameEngineTest(unittest.TestCase):
+    """The game engine on the in-memory repository"""
+
+    def setUp(self):
+        self.repository = MemoryRepository()
+        self.engine = GameEngine(self.repository)
+        self.user = self.engine.create_user('alice', 'alice@example.com')
+
+    def new_game(self, target='word', attempts=5):
+        game, = self.repository.new_games(self.user, attempts,
+                                          [(target, '*' * len(target))])
+        return self.repository.game_id(game)
+
+    def test_invalid_guess_rolls_back_batch(self):
+        game_id = self.new_game()
+        self.assertRaises(BadRequestError, self.engine.make_moves, game_id,
+                          [u'o', u'xy'])
+        game = self.engine.get_game(game_id)
+        self.assertEqual((game.attempts_remaining, game.current,
+                          game.history, game.version), (5, '****', '', 1))
+        self.assertEqual(self.repository.active_totals(), (1, 5))
+
+    def test_moves_stop_at_win(self):
+        game_id = self.new_game()
+        game, results = self.engine.make_moves(game_id,
+                                               [u'x', u'word', u'o'])
+        self.assertEqual([message for guess, message, current in results],
+                         ['You missed!', 'You win!'])
+        self.assertTrue(game.game_over)
+        self.assertEqual(self.repository.active_totals(), (0, 0))
+        user, scores = self.engine.user_scores('alice')
+        points = score_points('word', 3, True)
+        self.assertEqual([score.score for score in scores], [points])
+        self.assertEqual((user.games_played, user.total_score),
+                         (1, points))
+        game, results = self.engine.make_moves(game_id, [u'o'])
+        self.assertEqual(results, [(u'o', 'Game already over!', 'word')])
+
+    def test_no_guesses_write_nothing(self):
+        game_id = self.new_game()
+        game, results = self.engine.make_moves(game_id, [])
+        self.assertEqual(results, [])
+        self.assertEqual(self.engine.get_game(game_id).version, 1)
+
+    def test_cancel_game(self):
+        game_id = self.new_game(attempts=5)
+        won_id = self.new_game(attempts=7)
+        self.assertEqual(self.repository.active_totals(), (2, 12))
+        self.engine.cancel_game(game_id)
+        self.assertEqual(self.repository.active_totals(), (1, 7))
+        self.assertRaises(NotFoundError, self.engine.get_game, game_id)
+        self.assertRaises(NotFoundError, self.engine.cancel_game, game_id)
+        self.engine.make_moves(won_id, [u'word'])
+        self.assertRaises(BadRequestError, self.engine.cancel_game, won_id)
+        self.assertEqual(self.repository.active_totals(), (0, 0))
+        self.assertEqual(self.engine.average_attempts(), None)
+
+    def test_rankings_pages(self):
+        for i, target in enumerate(['a', 'ab', 'abc', 'abcd']):
+            user = self.engine.create_user('user{}'.format(i))
+            game, = self.repository.new_games(user, 5,
+                                              [(target, '*' * len(target))])
+            self.engine.make_moves(self.repository.game_id(game), [target])
+        names = []
+        cursor = None
+        while True:
+            users, cursor = self.engine.rankings(3, cursor)
+            names.append([user.name for user in users])
+            if not cursor:
+                break
+        self.assertEqual(names, [['user3', 'user2', 'user1'],
+                                 ['user0', 'alice']])
+        self.assertRaises(BadRequestError, self.engine.rankings, 3, 'next')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""test_models.py - Tests of the models against the App Engine testbed stubs.
+Needs the App Engine SDK, on sys.path or at the path in APPENGINE_SDK:
+
+    APPENGINE_SDK=~/google-cloud-sdk/platform/google_appengine \\
+        python -m unittest test_models
+"""
+
+import os
+import sys
+import unittest
+
+if os.environ.get('APPENGINE_SDK'):
+    sys.path.insert(0, os.environ['APPENGINE_SDK'])
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+from google.appengine.api import memcache
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from engine import score_points
+from models import User, Game, Score, ActiveGames, Leaderboard
+
+
+class EndGameTest(unittest.TestCase):
+    """Game.end_game_async and the updates it defers until its commit"""
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+        self.user = User.create('alice', 'alice@example.com')
+        self.game = Game.new_game(self.user.key, 5, 'word', 'wor*',
+                                  self.user.name)
+        self.game.current = 'word'
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def assertGameEnded(self):
+        points = score_points('word', 5, True)
+        self.assertEqual([score.score for score in Score.query()], [points])
+        user = self.user.key.get()
+        self.assertEqual((user.games_played, user.total_score), (1, points))
+        self.assertEqual(ActiveGames.totals(), (0, 0))
+        self.assertEqual([entry['score'] for entry
+                          in Leaderboard.get_entries(Leaderboard.ALL_TIME)],
+                         [points])
+        game = self.game.key.get()
+        self.assertTrue(game.game_over)
+        self.assertEqual(memcache.get(Game.MEMCACHE_VERSION.format(
+            game.key.urlsafe())), game.version)
+
+    def test_end_game(self):
+        self.game.end_game_async(True).get_result()
+        self.assertGameEnded()
+
+    def test_end_game_in_callers_transaction(self):
+        # As when make_moves ends the game
+        ndb.transaction(lambda: self.game.end_game_async(True).get_result(),
+                        xg=True)
+        self.assertGameEnded()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+"""transfer.py - Converts Users, Games and Scores to and from newline delimited
+JSON, for the admin export and import handlers in main.py. Keys are written as
+their (kind, id) paths so the data can be moved between apps."""
+
+import base64
+import json
+from datetime import datetime
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import User, UserName, Game, Score
+
+# The kinds that can be exported and imported
+MODELS = dict((model._get_kind(), model) for model in (User, Game, Score))
+
+# Entities read per datastore batch while exporting
+EXPORT_BATCH_SIZE = 500
+# Most entities in one export response, which keeps it within the response
+# size limit and the request deadline. The cursor continues the export
+EXPORT_LIMIT = 20000
+# Entities written per put_multi while importing
+IMPORT_BATCH_SIZE = 500
+
+DATE_FORMAT = '%Y-%m-%d'
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _encode_value(prop, value):
+    if value is None:
+        return None
+    if isinstance(prop, ndb.KeyProperty):
+        return value.flat()
+    # DateProperty extends DateTimeProperty, so it is checked first
+    if isinstance(prop, ndb.DateProperty):
+        return value.strftime(DATE_FORMAT)
+    if isinstance(prop, ndb.DateTimeProperty):
+        return value.strftime(DATETIME_FORMAT)
+    # Both extend BlobProperty but hold JSON friendly values
+    if isinstance(prop, (ndb.JsonProperty, ndb.TextProperty)):
+        return value
+    if isinstance(prop, ndb.BlobProperty):
+        return base64.b64encode(value)
+    return value
+
+
+def _decode_value(prop, value):
+    if value is None:
+        return None
+    if isinstance(prop, ndb.KeyProperty):
+        return ndb.Key(flat=value)
+    if isinstance(prop, ndb.DateProperty):
+        return datetime.strptime(value, DATE_FORMAT).date()
+    if isinstance(prop, ndb.DateTimeProperty):
+        return datetime.strptime(value, DATETIME_FORMAT)
+    if isinstance(prop, (ndb.JsonProperty, ndb.TextProperty)):
+        return value
+    if isinstance(prop, ndb.BlobProperty):
+        return base64.b64decode(value)
+    return value
+
+
+def to_json(entity):
+    """Returns the entity as one line of JSON"""
+    record = {'key': entity.key.flat()}
+    for name, prop in entity._properties.iteritems():
+        value = prop._get_value(entity)
+        if prop._repeated:
+            record[name] = [_encode_value(prop, v) for v in value]
+        else:
+            record[name] = _encode_value(prop, value)
+    return json.dumps(record, sort_keys=True)
+
+
+def from_json(model, line):
+    """Returns the entity of model that a line written by to_json holds.
+    Properties the model no longer has are dropped
+    Raises:
+        ValueError: if the line is not JSON or the key is of another kind"""
+    record = json.loads(line)
+    key = ndb.Key(flat=record.pop('key'))
+    if key.kind() != model._get_kind():
+        raise ValueError('Incorrect Kind')
+    entity = model(key=key)
+    for name, value in record.iteritems():
+        prop = model._properties.get(name)
+        if prop is None:
+            continue
+        if prop._repeated:
+            value = [_decode_value(prop, v) for v in value or []]
+        else:
+            value = _decode_value(prop, value)
+        prop._set_value(entity, value)
+    return entity
+
+
+def export(model, write, urlsafe_cursor=None, limit=EXPORT_LIMIT):
+    """Writes up to limit entities of model, one JSON line per write call.
+    They are read EXPORT_BATCH_SIZE at a time and kept out of the context
+    cache, so memory does not grow with the number exported.
+    Returns:
+        The urlsafe cursor to continue the export from, or None when every
+        entity was written.
+    Raises:
+        datastore_errors.BadValueError: if the cursor string is malformed."""
+    cursor = Cursor(urlsafe=urlsafe_cursor) if urlsafe_cursor else None
+    entities = model.query().iter(batch_size=EXPORT_BATCH_SIZE,
+                                  start_cursor=cursor, produce_cursors=True,
+                                  use_cache=False)
+    count = 0
+    for entity in entities:
+        write(to_json(entity) + '\n')
+        count += 1
+        if count >= limit:
+            if entities.probably_has_next():
+                return entities.cursor_after().urlsafe()
+            break
+    return None
+
+
+class ImportFailed(Exception):
+    """An import stopped part way, because of error. imported counts the
+    entities of the model that were written before it stopped"""
+
+    def __init__(self, imported, error):
+        Exception.__init__(self, str(error))
+        self.imported = imported
+        self.error = error
+
+
+def _written(futures, count):
+    """Waits for the puts of a batch, raising their errors. Returns count"""
+    for future in futures:
+        future.get_result()
+    return count
+
+
+def import_lines(model, lines):
+    """Writes the entities of model held by JSON lines with put_multi,
+    IMPORT_BATCH_SIZE at a time. Each batch is written while the next one is
+    parsed. Users also get the UserName that claims their name. Games get a
+    new updated time and their version is bumped, like on any other write.
+    Returns:
+        How many entities of model were written.
+    Raises:
+        ImportFailed: if a line is not an entity of model, its error being a
+            ValueError, or if a batch could not be written."""
+    count = 0
+    batch = []
+    batch_count = 0
+    pending = []
+    pending_count = 0
+    try:
+        for line in lines:
+            if not line.strip():
+                continue
+            entity = from_json(model, line)
+            batch.append(entity)
+            batch_count += 1
+            if model is User:
+                batch.append(UserName(id=UserName.normalize(entity.name),
+                                      user=entity.key))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                count += _written(pending, pending_count)
+                pending, pending_count = [], 0
+                pending = ndb.put_multi_async(batch, use_cache=False)
+                pending_count = batch_count
+                batch = []
+                batch_count = 0
+        count += _written(pending, pending_count)
+        pending, pending_count = [], 0
+        ndb.put_multi(batch, use_cache=False)
+        return count + batch_count
+    except Exception, e:
+        try:
+            # The batch being written when a line failed may still succeed
+            count += _written(pending, pending_count)
+        except Exception:
+            pass
+        raise ImportFailed(count, e)
@@ -1,35 +1,158 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+import time
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
-import endpoints
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+import cache
+from repository import clamp_page_size
+
+MEMCACHE_TASKS_SCHEDULED = 'TASKS_SCHEDULED_{}'
+MEMCACHE_TASKS_COALESCED = 'TASKS_COALESCED_{}'
+
+
+def bad_request(message):
+    """Returns an endpoints.BadRequestException. endpoints is only imported
+    here so the task and cron handlers can use these helpers without
+    loading the endpoints stack"""
+    import endpoints
+    return endpoints.BadRequestException(message)
+
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key that the urlsafe key string points to without
+        reading the entity. Checks that the key is of the expected kind.
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The ndb.Key decoded from the urlsafe key string.
     Raises:
         ValueError:"""
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError:
-        raise endpoints.BadRequestException('Invalid Key')
+        raise bad_request('Invalid Key')
     except Exception, e:
         if e.__class__.__name__ == 'ProtocolBufferDecodeError':
-            raise endpoints.BadRequestException('Invalid Key')
+            raise bad_request('Invalid Key')
         else:
             raise
 
-    entity = key.get()
+    if key.kind() != model._get_kind():
+        raise ValueError('Incorrect Kind')
+    return key
+
+
+def get_by_urlsafe(urlsafe, model):
+    """Returns an ndb.Model entity that the urlsafe key points to, read
+        through the entity cache if the model uses it. Checks
+        that the type of entity returned is of the correct kind. Raises an
+        error if the key String is malformed or the entity is of the incorrect
+        kind
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The entity that the urlsafe Key string points to or None if no entity
+        exists.
+    Raises:
+        ValueError:"""
+    entity = cache.get(get_key_by_urlsafe(urlsafe, model), model)
     if not entity:
         return None
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
     return entity
+
+def get_multi_by_urlsafe(urlsafes, model):
+    """Returns the ndb.Model entities that the urlsafe keys point to, read
+        through the entity cache with one batch read per cache layer.
+    Args:
+        urlsafes: A list of urlsafe key strings
+        model: The expected entity kind
+    Returns:
+        The entities in the order of the urlsafe key strings, with None for
+        the keys that point to no entity.
+    Raises:
+        ValueError:"""
+    keys = [get_key_by_urlsafe(urlsafe, model) for urlsafe in urlsafes]
+    entities = cache.get_multi(keys, model)
+    for entity in entities:
+        if entity and not isinstance(entity, model):
+            raise ValueError('Incorrect Kind')
+    return entities
+
+def fetch_page(query, page_size=None, urlsafe_cursor=None, **options):
+    """Fetches a single page of results from a query. The page size falls
+        back to DEFAULT_PAGE_SIZE and is capped at MAX_PAGE_SIZE so a single
+        request never materializes an unbounded result set.
+    Args:
+        query: The ndb.Query to page through
+        page_size: The requested number of results
+        urlsafe_cursor: A urlsafe cursor string returned by a previous page
+        options: Extra query options passed on to fetch_page
+    Returns:
+        A tuple of the results and the urlsafe cursor string of the next page,
+        or None if there are no more results.
+    Raises:
+        endpoints.BadRequestException: if the cursor string is malformed."""
+    page_size = clamp_page_size(page_size)
+    try:
+        cursor = Cursor(urlsafe=urlsafe_cursor) if urlsafe_cursor else None
+    except datastore_errors.BadValueError:
+        raise bad_request('Invalid Cursor')
+
+    results, next_cursor, more = query.fetch_page(page_size,
+                                                  start_cursor=cursor,
+                                                  **options)
+    if more and next_cursor:
+        return results, next_cursor.urlsafe()
+    return results, None
+
+
+def add_coalesced_task(name, url, window, **options):
+    """Adds a task unless one with the same name is already pending for the
+        current time window. The task is named after the window and runs when
+        the window closes, so a burst of calls produces a single task.
+    Args:
+        name: The task name prefix, unique per kind of background work
+        url: The url of the task handler
+        window: The debounce interval in seconds
+        options: Extra task options passed on to taskqueue.Task
+    Returns:
+        True if a task was added, False if the call was coalesced into the
+        pending task."""
+    return add_coalesced_task_async(name, url, window, **options).get_result()
+
+
+@ndb.tasklet
+def add_coalesced_task_async(name, url, window, **options):
+    """Asynchronous add_coalesced_task, so the enqueue can overlap datastore
+    RPCs. Returns a Future"""
+    now = time.time()
+    bucket = int(now // window)
+    task = taskqueue.Task(name='{}-{}'.format(name, bucket), url=url,
+                          countdown=int((bucket + 1) * window - now),
+                          **options)
+    context = ndb.get_context()
+    try:
+        yield taskqueue.Queue().add_async(task)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        yield context.memcache_incr(MEMCACHE_TASKS_COALESCED.format(name),
+                                    initial_value=0)
+        raise ndb.Return(False)
+    yield context.memcache_incr(MEMCACHE_TASKS_SCHEDULED.format(name),
+                                initial_value=0)
+    raise ndb.Return(True)
+
+
+def get_coalesced_task_stats(name):
+    """Returns how many tasks add_coalesced_task added and how many calls it
+    coalesced for the given task name since memcache was last flushed"""
+    return (memcache.get(MEMCACHE_TASKS_SCHEDULED.format(name)) or 0,
+            memcache.get(MEMCACHE_TASKS_COALESCED.format(name)) or 0)
@@ -1,102 +1,137 @@
-"""the dictionary for the game """
-
-
-wordlist = ["the", "of", "and", "to", "a", \
-"in", "for", "is", "on", "that", "by", "this",\
-"with", "i", "you", "it", "not", "or", "be", \
-"are", "from", "at", "as", "your", "all", "have", \
-"new", "more", "an", "was", "we", "will", "home", \
-"can", "us", "about", "if", "page", "my", "has", \
-"search", "free", "but", "our", "one", "other", "do", \
-"no", "information", "time", "they", "site", "he", "up", \
-"may", "what", "which", "their", "news", "out", "use", "any", \
-"there", "see", "only", "so", "his", "when", "contact", "here", \
-"business", "who", "web", "also", "now", "help", "get", "pm", \
-"view", "online", "c", "e", "first", "am", "been", "would", \
-"how", "were", "me", "s", "services", "some", "these", "click", \
-"its", "like", "service", "x", "than", "find", "price", "date", \
-"back", "top", "people", "had", "list", "name", "just", "over", \
-"state", "year", "day", "into", "email", "two", "health", "n", \
-"world", "re", "next", "used", "go", "b", "work", "last", "most", \
-"products", "music", "buy", "data", "make", "them", "should", \
-"product", "system", "post", "her", "city", "t", "add", "policy", \
-"number", "such", "please", "available", "copyright", "support", \
-"message", "after", "best", "software", "then", "jan", "good", \
-"video", "well", "d", "where", "info", "rights", "public", \
-"books", "high", "school", "through", "m", "each", "links", \
-"she", "review", "years", "order", "very", "privacy", "book", \
-"items", "company", "r", "read", "group", "sex", "need", "many", "user", \
-"said", "de", "does", "set", "under", "general", "research", \
-"university", "january", "mail", "full", "map", "reviews", "program", \
-"life", "know", "games", "way", "days", "management", "p", \
-"part", "could", "great", "united", "hotel", "real", "f", \
-"item", "international", "center", "ebay", "must", "store", \
-"travel", "comments", "made", "development", "report", "off", \
-"member", "details", "line", "terms", "before", "hotels", "did", \
-"send", "right", "type", "because", "local", "those", "using", \
-"results", "office", "education", "national", "car", "design", \
-"take", "posted", "internet", "address", "community", "within", \
-"states", "area", "want", "phone", "dvd", "shipping", "reserved", \
-"subject", "between", "forum", "family", "l", "long", "based", "w", \
-"code", "show", "o", "even", "black", "check", "special", "prices", \
-"website", "index", "being", "women", "much", "sign", "file", \
-"link", "open", "today", "technology", "south", "case", "project", \
-"same", "pages", "uk", "version", "section", "own", "found", \
-"sports", "house", "related", "security", "both", "g", "county", \
-"american", "photo", "game", "members", "power", "while", \
-"care", "network", "down", "computer", "systems", "three", "total", \
-"place", "end", "following", "download", "h", "him", "without", \
-"per", "access", "think", "north", "resources", "current", \
-"posts", "big", "media", "law", "control", "water", "history", \
-"pictures", "size", "art", "personal", "since", "including", \
-"guide", "shop", "directory", "board", "location", "change", \
-"white", "text", "small", "rating", "rate", "government", \
-"children", "during", "usa", "return", "students", "v", "shopping", \
-"account", "times", "sites", "level", "digital", "profile", \
-"previous", "form", "events", "love", "old", "john", "main", \
-"call", "hours", "image", "department", "title", "description", \
-"non", "k", "y", "insurance", "another", "why", "shall", \
-"property", "class", "cd", "still", "money", "quality", "every", \
-"listing", "content", "country", "private", "little", "visit", \
-"save", "tools", "low", "reply", "customer", "december", \
-"compare", "movies", "include", "college", "value", "article", \
-"york", "man", "card", "jobs", "provide", "j", "food", \
-"source", "author", "different", "press", "u", "learn", \
-"sale", "around", "print", "course", "job", "canada", \
-"process", "teen", "room", "stock", "training", "too", \
-"credit", "point", "join", "science", "men", "categories", \
-"advanced", "west", "sales", "look", "english", "left", \
-"team", "estate", "box", "conditions", "select", "windows", \
-"photos", "gay", "thread", "week", "category", "note", \
-"live", "large", "gallery", "table", "register", "however", \
-"june", "october", "november", "market", "library", "really", \
-"action", "start", "series", "model", "features", "air", \
-"industry", "plan", "human", "provided", "tv", "yes", "required", \
-"second", "hot", "accessories", "cost", "movie", "forums", \
-"march", "la", "september", "better", "say", "questions", \
-"july", "yahoo", "going", "medical", "test", "friend", "come", \
-"dec", "server", "pc", "study", "application", "cart", \
-"staff", "articles", "san", "feedback", "again", "play", \
-"looking", "issues", "april", "never", "users", "complete", \
-"street", "topic", "comment", "financial", "things", "working", \
-"against", "standard", "tax", "person", "below", "mobile", \
-"less", "got", "blog", "party", "payment", "equipment", "login", \
-"student", "let", "programs", "offers", "legal", "above", \
-"recent", "park", "stores", "side", "act", "problem", "red", \
-"give", "memory", "performance", "social", "q", "august", \
-"quote", "language", "story", "sell", "options", "experience", \
-"rates", "create", "key", "body", "young", "america", "important", \
-"field", "few", "east", "paper", "single", "ii", "age", \
-"activities", "club", "example", "girls", "additional", "password", \
-"z", "latest", "something", "road", "gift", "question", "changes", \
-"night", "ca", "hard", "texas", "oct", "pay", "four", "poker", \
-"status", "browse", "issue", "range", "building", "seller", \
-"court", "february", "always", "result", "audio", "light", "write", \
-"war", "nov", "offer", "blue", "groups", "al", "easy", "given", \
-"files", "event", "release", "analysis", "request", "fax", "china", \
-"making", "picture", "needs", "possible", "might", "professional", \
-"yet", "month", "major", "star", "areas", "future", "space", \
-"committee", "hand", "sun", "cards", "problems", "london", "washington", \
-"meeting", "rss", "become", "interest", "id", "child", "keep", "enter", \
-"california", "porn", "share", "similar", "garden", "schools", \
-"million", "added", "reference", "companies", "listed", "baby", "learning"]
\ No newline at end of file
+"""the dictionary for the game, plus the pure game logic that reveals the
+letters of a masked word """
+
+import os
+import random
+
+MASK = "*"
+
+# One lower case word per line, lines starting with '#' are ignored
+DICTIONARY_PATH = os.path.join(os.path.dirname(__file__), 'words.txt')
+
+# Difficulty buckets by the number of distinct letters a player must find
+EASY = 'easy'
+MEDIUM = 'medium'
+HARD = 'hard'
+
+# Attempts at drawing a word that is not excluded before scanning instead
+MAX_DRAWS = 16
+
+
+def letter_positions(word):
+    """Maps each letter of word to the tuple of positions it occurs at"""
+    positions = {}
+    for i, letter in enumerate(word):
+        positions.setdefault(letter, []).append(i)
+    return dict((letter, tuple(p)) for letter, p in positions.iteritems())
+
+
+def difficulty(word):
+    """Returns the difficulty bucket of word"""
+    distinct = len(set(word))
+    if distinct <= 4:
+        return EASY
+    if distinct <= 7:
+        return MEDIUM
+    return HARD
+
+
+class Dictionary(object):
+    """Word list indexed by length and difficulty. The file is only read the
+    first time a word is needed so instance startup does not pay for it"""
+
+    def __init__(self, path=DICTIONARY_PATH):
+        self.path = path
+        self._buckets = None
+        self._positions = {}
+
+    def _load(self):
+        """Reads the word file and buckets the words by difficulty and
+        length"""
+        buckets = {}
+        with open(self.path) as f:
+            for line in f:
+                word = line.strip().lower()
+                if not word or word.startswith('#'):
+                    continue
+                buckets.setdefault((difficulty(word), len(word)),
+                                   []).append(word)
+        self._buckets = buckets
+
+    @property
+    def buckets(self):
+        """The words keyed by (difficulty, length)"""
+        if self._buckets is None:
+            self._load()
+        return self._buckets
+
+    def __len__(self):
+        return sum(len(words) for words in self.buckets.itervalues())
+
+    def choice(self, min_length=None, max_length=None, level=None,
+               exclude=()):
+        """Returns a random word matching the filters. Only the buckets are
+        walked, never the words, so the cost does not grow with the size of
+        the dictionary. Returns None if no word matches."""
+        candidates = [words for (bucket_level, length), words
+                      in self.buckets.iteritems()
+                      if (min_length is None or length >= min_length) and
+                      (max_length is None or length <= max_length) and
+                      (level is None or bucket_level == level)]
+        total = sum(len(words) for words in candidates)
+        if not total:
+            return None
+        for _ in range(MAX_DRAWS):
+            word = self._draw(candidates, total)
+            if word not in exclude:
+                return word
+        remaining = [candidate for words in candidates for candidate in words
+                     if candidate not in exclude]
+        return random.choice(remaining) if remaining else None
+
+    @staticmethod
+    def _draw(candidates, total):
+        """Draws a word uniformly from the candidate buckets"""
+        index = random.randrange(total)
+        for words in candidates:
+            if index < len(words):
+                return words[index]
+            index -= len(words)
+
+    def positions(self, word):
+        """Returns the letter positions of word, computed once per word"""
+        positions = self._positions.get(word)
+        if positions is None:
+            positions = self._positions[word] = letter_positions(word)
+        return positions
+
+
+dictionary = Dictionary()
+
+
+def mask(word):
+    """Returns the fully masked form of word"""
+    return MASK * len(word)
+
+
+def reveal(target, current, letter):
+    """Reveals every occurrence of letter in the masked word current in a
+    single pass. Returns the new masked word and whether the letter hit"""
+    hits = dictionary.positions(target).get(letter)
+    if not hits:
+        return current, False
+    revealed = list(current)
+    for i in hits:
+        revealed[i] = letter
+    return "".join(revealed), True
+
+
+def apply_guess(target, current, guess):
+    """Applies a guess of one letter or the whole word to the masked word
+    current. Returns the new masked word and whether the guess hit"""
+    guess = guess.lower()
+    if len(guess) == len(target):
+        if guess == target:
+            return target, True
+        return current, False
+    return reveal(target, current, guess)